@@ -1,7 +1,10 @@
+from contextlib import nullcontext
+
 import numpy as np
 from numpy.polynomial.chebyshev import Chebyshev
-from lmfit import Parameters, Model
-from model import master_function
+from model import master_function, ModelPlan, JointPlan, ContinuumPlan
+import profiling
+import fit_store
 
 
 
@@ -45,6 +48,19 @@ def fit_continuum(wavelength, flux, absorption_range, degree, return_std=False):
 
 
 
+def _free_parameter_map(params, plan):
+    """
+    Names of the free lmfit parameters (in lmfit order) and the matrix d(theta)/d(free
+    parameters) of the plan's flat parameter vector: b and N map one to one, a master v_rad
+    parameter collects the v_rad entries of all components tied to it.
+    """
+    var_names = [name for name, par in params.items() if par.vary]
+    dtheta = np.zeros((len(plan.param_names), len(var_names)))
+    for k, name in enumerate(plan.param_names):
+        dtheta[k, var_names.index(params[name].expr or name)] = 1.0
+    return var_names, dtheta
+
+
 # --- Wrapper for model evaluation ---
 def Voigt_fit_wrapper(**params_list):
     """
@@ -58,7 +74,18 @@ def Voigt_fit_wrapper(**params_list):
     - For each species i: n_trans_i, n_component_i
     - For each transition j in species i: lambda_i_j, f_i_j, gamma_i_j
     - For each component k in species i: v_rad_i_k, b_i_k, N_i_k
+    - plan (optional): a ModelPlan of the same species; when given, only the
+      b, N and v_rad values are read and the model is evaluated through the plan
     """
+    with profiling.stage('wrapper'):
+        return _voigt_fit_model(params_list)
+
+
+def _voigt_fit_model(params_list):
+    plan = params_list.get('plan')
+    if plan is not None:
+        return plan.evaluate([params_list[name] for name in plan.param_names])
+
     n_species = params_list['n_species']
     wavegrid = params_list['wavegrid']
     v_resolution = params_list['v_resolution']
@@ -69,7 +96,7 @@ def Voigt_fit_wrapper(**params_list):
     
     for species_idx in range(int(n_species)):
         n_trans = params_list[f'n_trans_{species_idx}']
-        n_component = params_list[f'n_component_{species_idx}']
+        n_component = int(float(params_list[f'n_component_{species_idx}']))
         
         # Extract transition parameters for this species
         n_trans = int(float(n_trans)) 
@@ -133,49 +160,14 @@ def Voigt_fit_wrapper(**params_list):
     
     return model
 
-def astro_voigt_fit(
-    wavegrid, 
-    ydata, 
-    species_params,
-    v_resolution=0.0, 
-    n_step=25, 
-    std_dev=0.02
-):
+def _species_parameters(species_params, v_resolution, n_step):
     """
-    Generalized fitting function for multiple species with v_rad constraints.
-    
-    Parameters:
-    -----------
-    wavegrid : array
-        Wavelength grid
-    ydata : array
-        Observed data to fit
-    species_params : dict
-        Dictionary containing parameters for each species.
-        Structure: {
-            0: {  # species index
-                'lambda': [list of wavelengths],
-                'f': [list of f values],
-                'gamma': [list of gamma values],
-                'b': [list of b values for each component],
-                'N': [list of N values for each component],
-                'v_rad': [list of radial velocities for each component]
-            },
-            1: { ... },  # next species
-            ...
-        }
-    v_resolution : float
-        Velocity resolution
-    n_step : int
-        Number of steps
-    std_dev : float
-        Standard deviation for weighting
-        
-    Returns:
-    --------
-    result : lmfit.model.ModelResult
-        Fitting result
+    lmfit Parameters of species_params as set up by astro_voigt_fit: the fixed transition
+    data, free b and N for every component, and v_rad tied to master v_rad parameters.
+    species_params is converted to numpy arrays in place.
     """
+    # lmfit (and the pandas and matplotlib it pulls in) is only imported once a fit is set up
+    from lmfit import Parameters
     
     n_species = len(species_params)
     
@@ -250,13 +242,328 @@ def astro_voigt_fit(
             master_param_name = master_v_rad_params[(i, v_rad_value)]
             params.add(f'v_rad_{species_idx}_{i}', expr=master_param_name)
     
+    return params
+
+
+def _fit_plan(ydata, params, plan, weights, jacobian=None, profile=False, max_nfev=None):
+    # fit ydata with the model of plan (a ModelPlan or JointPlan); see astro_voigt_fit
+    from lmfit import Model
+    
+    fit_kws = None
+    if jacobian == "analytic":
+        dtheta = _free_parameter_map(params, plan)[1]
+        
+        def Voigt_fit_jacobian(pars, data, weights, **kwargs):
+            model, jac = plan.jacobian([pars[name].value for name in plan.param_names])
+            # residual is (data - model) * weights
+            return -(jac @ dtheta) * np.reshape(weights, (-1, 1))
+        
+        fit_kws = {'Dfun': Voigt_fit_jacobian}
+    elif jacobian is not None:
+        raise ValueError(f"Unknown jacobian '{jacobian}', use None or 'analytic'")
+    
     # Creating model and fitting by passing the inputs to the wrapper 
-    voigtmod = Model(Voigt_fit_wrapper, independent_vars=['wavegrid'])
-    result = voigtmod.fit(ydata, params, wavegrid=wavegrid, weights=1/std_dev)
+    voigtmod = Model(Voigt_fit_wrapper, independent_vars=['wavegrid', 'plan'])
+    with (profiling.profile() if profile else nullcontext()) as fit_profile:
+        result = voigtmod.fit(ydata, params, wavegrid=plan.wavegrid, plan=plan, weights=weights,
+                              fit_kws=fit_kws, max_nfev=max_nfev)
+    if profile:
+        result.profile = fit_profile.record()
+    result.culled_lines = plan.culling_report([result.params[name].value for name in plan.param_names])
+    
+    return result
+
+
+def astro_voigt_fit(
+    wavegrid, 
+    ydata, 
+    species_params,
+    v_resolution=0.0, 
+    n_step=25, 
+    std_dev=0.02,
+    backend="scipy",
+    jacobian=None,
+    lsf=None,
+    flux_tol=0.0,
+    profile=False,
+    max_nfev=None,
+    max_memory=None,
+    continuum_degree=None,
+    store_key=None
+):
+    """
+    Generalized fitting function for multiple species with v_rad constraints.
+    
+    Parameters:
+    -----------
+    wavegrid : array
+        Wavelength grid
+    ydata : array
+        Observed data to fit
+    species_params : dict
+        Dictionary containing parameters for each species.
+        Structure: {
+            0: {  # species index
+                'lambda': [list of wavelengths],
+                'f': [list of f values],
+                'gamma': [list of gamma values],
+                'b': [list of b values for each component],
+                'N': [list of N values for each component],
+                'v_rad': [list of radial velocities for each component]
+            },
+            1: { ... },  # next species
+            ...
+        }
+    v_resolution : float
+        Velocity resolution
+    n_step : int
+        Number of steps
+    std_dev : float
+        Standard deviation for weighting
+    backend : str
+        Faddeeva backend for the Voigt profiles: "scipy" (exact), the faster
+        numba compiled "humlicek" / "weideman" approximations, or the "table" lookup
+    jacobian : str or None
+        None (default) lets lmfit use finite differences; "analytic" supplies the
+        analytic Jacobian of the model with respect to b, N and the master v_rad
+        parameters, so each iteration needs a single model evaluation
+    lsf : tuple or None
+        Tabulated line spread function (lsf_wave, lsf_velocity, lsf_kernel) used
+        instead of a Gaussian of v_resolution; v_resolution still sets the sampling
+    flux_tol : float
+        Lines with a peak depth below flux_tol (in normalised flux) are not evaluated;
+        lines outside wavegrid never are. The lines culled at the best fit are listed
+        in result.culled_lines (see ModelPlan.culling_report)
+    profile : bool
+        Time the model stages (line culling, grid construction, optical depth, operator
+        lookup, broadening, interpolation), the model and Jacobian evaluations and lmfit
+        itself, and count the evaluations and reference grid sizes. The summary is stored
+        in result.profile (see profiling.FitProfile.record)
+    max_nfev : int or None
+        Maximum number of model evaluations (None: lmfit's default)
+    max_memory : int or None
+        Memory budget (bytes) of a model evaluation, for long grids with many lines;
+        see ModelPlan. The analytic Jacobian is not chunked.
+    continuum_degree : int or None
+        Fit the continuum together with the lines: ydata (and std_dev) is then the
+        unnormalised flux, modelled as the absorption times a Chebyshev polynomial of this
+        degree over wavegrid. The polynomial coefficients are solved by linear least squares
+        at every step (see model.ContinuumPlan), so the fit has no extra free parameters and
+        no separate fit_continuum pass is needed
+    store_key : tuple or None
+        (star, file, species, wave_range) of the data, with species the tuple of species
+        names. The b, N and v_rad guesses are then replaced by the most recent converged fit
+        of the same key, or of the same star, species and wave_range in another exposure,
+        from the fit store (see fit_store.seed), and a converged result is added to the store.
+        result.warm_start is 'exact', 'neighbour' or None (no stored fit)
+        
+    Returns:
+    --------
+    result : lmfit.model.ModelResult
+        Fitting result; with continuum_degree, result.continuum holds the fitted continuum on
+        wavegrid and result.continuum_poly the numpy Chebyshev polynomial (as from
+        fit_continuum)
+    """
+    
+    if store_key is not None:
+        species_params, warm_start = fit_store.seed(species_params, store_key)
+    
+    params = _species_parameters(species_params, v_resolution, n_step)
+    
+    # All static work (unit conversions, grid spacing, line tiling) is done once here
+    plan = ModelPlan(wavegrid, species_params, v_resolution=v_resolution, n_step=n_step,
+                     backend=backend, lsf=lsf, flux_tol=flux_tol, max_memory=max_memory)
+    if continuum_degree is not None:
+        plan = ContinuumPlan(plan, ydata, 1/std_dev, degree=continuum_degree)
+    result = _fit_plan(ydata, params, plan, 1/std_dev, jacobian=jacobian, profile=profile,
+                       max_nfev=max_nfev)
+    if continuum_degree is not None:
+        coefficients = plan.coefficients([result.params[name].value for name in plan.param_names])
+        result.continuum = plan.basis @ coefficients
+        result.continuum_poly = Chebyshev(coefficients, domain=plan.domain)
+    if store_key is not None:
+        result.warm_start = warm_start
+        if result.success:
+            fit_store.record_fit(store_key, result, species_params)
     
     return result  # great that you are reading this :)
 
 
+def astro_voigt_fit_joint(
+    exposures,
+    species_params,
+    n_step=25,
+    backend="scipy",
+    jacobian=None,
+    velocity_offsets=False,
+    flux_tol=0.0,
+    profile=False,
+    max_nfev=None,
+    max_memory=None
+):
+    """
+    Fit several exposures of the same target at once, with b, N and v_rad shared by all of them.
+
+    Every exposure keeps its own wavelength grid, noise and resolution; their reference grids
+    and broadening operators are set up once (see model.JointPlan) and the residuals of all
+    exposures are minimised together. One joint fit replaces fitting the exposures one by one
+    and averaging the results, and constrains the parameters better.
+
+    Parameters:
+    -----------
+    exposures : list of tuples
+        (wavegrid, ydata, std_dev, v_resolution) of every exposure; std_dev is a float or an
+        array of the size of ydata
+    species_params : dict
+        As for astro_voigt_fit
+    n_step, backend, jacobian, flux_tol, profile, max_nfev, max_memory :
+        As for astro_voigt_fit
+    velocity_offsets : bool
+        Fit a velocity offset v_offset_<e> (km/s) for every exposure e > 0, relative to
+        exposure 0, e.g. for residual wavelength calibration differences
+
+    Returns:
+    --------
+    result : lmfit.model.ModelResult
+        Fitting result on the concatenated exposures; result.exposure_fits holds the best fit
+        of every exposure and result.culled_lines also has the exposure of every line
+    """
+    params = _species_parameters(species_params, 0.0, n_step)
+    plans = [ModelPlan(wavegrid, species_params, v_resolution=v_resolution, n_step=n_step,
+                       backend=backend, flux_tol=flux_tol, max_memory=max_memory)
+             for wavegrid, _, _, v_resolution in exposures]
+    plan = JointPlan(plans, velocity_offsets=velocity_offsets)
+    if velocity_offsets:
+        for name in plan.param_names[3 * plan.n_components:]:
+            params.add(name, value=0.0)
+    
+    ydata = np.concatenate([np.asarray(exposure[1], dtype=float) for exposure in exposures])
+    weights = np.concatenate([np.broadcast_to(1 / np.asarray(std_dev, dtype=float), np.shape(flux))
+                              for _, flux, std_dev, _ in exposures])
+    result = _fit_plan(ydata, params, plan, weights, jacobian=jacobian, profile=profile,
+                       max_nfev=max_nfev)
+    result.exposure_fits = plan.split(result.best_fit)
+    
+    return result
+
+
+def astro_voigt_sample(
+    wavegrid,
+    ydata,
+    species_params,
+    v_resolution=0.0,
+    n_step=25,
+    std_dev=0.02,
+    backend="scipy",
+    lsf=None,
+    flux_tol=0.0,
+    n_walkers=64,
+    n_steps=2000,
+    burn=None,
+    thin=1,
+    seed=None,
+    fit_result=None
+):
+    """
+    Sample the posterior of the free parameters of astro_voigt_fit with an affine invariant
+    ensemble sampler (Goodman & Weare 2010 stretch move, as in emcee).
+
+    The walkers are split in two halves that are updated in turn, so the models of a whole
+    half are evaluated in one ModelPlan.evaluate_many call. The likelihood is Gaussian with
+    sigma std_dev, the priors are flat within the bounds of the fit parameters (b in
+    [0.5, 5.5], N >= 0).
+
+    Parameters:
+    -----------
+    wavegrid, ydata, species_params, v_resolution, n_step, std_dev, backend, lsf, flux_tol :
+        As for astro_voigt_fit
+    n_walkers : int
+        Number of walkers (even, at least twice the number of free parameters)
+    n_steps : int
+        Number of steps of every walker
+    burn : int
+        Number of initial steps left out of flatchain (default n_steps // 2)
+    thin : int
+        Keep every thin-th step in flatchain
+    seed : int
+        Seed of the random number generator
+    fit_result : lmfit.model.ModelResult
+        Result of astro_voigt_fit to start from; by default astro_voigt_fit is run first
+        (with the analytic Jacobian). The walkers start in a small ball around its best fit.
+
+    Returns:
+    --------
+    result : lmfit.model.ModelResult
+        The fit result, with the parameter values and errors replaced by the median and
+        standard deviation of the samples, and the attributes chain (n_steps, n_walkers,
+        n_free), lnprob (n_steps, n_walkers), acceptance_fraction (n_walkers) and flatchain
+        (pandas DataFrame of the samples after burn and thin), as in lmfit's emcee method
+    """
+    import pandas as pd
+
+    if fit_result is None:
+        fit_result = astro_voigt_fit(wavegrid, ydata, species_params, v_resolution=v_resolution,
+                                     n_step=n_step, std_dev=std_dev, backend=backend,
+                                     jacobian="analytic", lsf=lsf, flux_tol=flux_tol)
+    plan = fit_result.userkws['plan']
+    params = fit_result.params
+    var_names, dtheta = _free_parameter_map(params, plan)
+    n_var = len(var_names)
+    if n_walkers % 2 or n_walkers < 2 * n_var:
+        raise ValueError(f"n_walkers must be even and at least {2 * n_var}, got {n_walkers}")
+
+    ydata = np.asarray(ydata, dtype=float)
+    lower = np.array([params[name].min for name in var_names])
+    upper = np.array([params[name].max for name in var_names])
+
+    def log_prob(x):
+        lp = np.full(len(x), -np.inf)
+        inside = np.all((x >= lower) & (x <= upper), axis=1)
+        if np.any(inside):
+            models = plan.evaluate_many(x[inside] @ dtheta.T)
+            lp[inside] = -0.5 * np.sum(((ydata - models) / std_dev) ** 2, axis=1)
+        return lp
+
+    # start in a small ball around the best fit
+    rng = np.random.default_rng(seed)
+    best = np.array([params[name].value for name in var_names])
+    scale = np.array([params[name].stderr or 0.0 for name in var_names])
+    scale = np.where(np.isfinite(scale) & (scale > 0), scale, 1e-3 * np.abs(best) + 1e-3)
+    walkers = np.clip(best + 0.1 * scale * rng.standard_normal((n_walkers, n_var)), lower, upper)
+    lp = log_prob(walkers)
+
+    a = 2.0  # stretch scale
+    half = n_walkers // 2
+    chain = np.empty((n_steps, n_walkers, n_var))
+    lnprob = np.empty((n_steps, n_walkers))
+    accepted = np.zeros(n_walkers)
+    for step in range(n_steps):
+        for active, other in ((slice(0, half), slice(half, None)), (slice(half, None), slice(0, half))):
+            z = ((a - 1.0) * rng.random(half) + 1.0) ** 2 / a
+            partners = walkers[other][rng.integers(half, size=half)]
+            proposal = partners + z[:, None] * (walkers[active] - partners)
+            lp_proposal = log_prob(proposal)
+            accept = np.log(rng.random(half)) < (n_var - 1) * np.log(z) + lp_proposal - lp[active]
+            walkers[active] = np.where(accept[:, None], proposal, walkers[active])
+            lp[active] = np.where(accept, lp_proposal, lp[active])
+            accepted[active] += accept
+        chain[step] = walkers
+        lnprob[step] = lp
+
+    burn = n_steps // 2 if burn is None else burn
+    samples = chain[burn::thin].reshape(-1, n_var)
+    fit_result.chain = chain
+    fit_result.lnprob = lnprob
+    fit_result.acceptance_fraction = accepted / n_steps
+    fit_result.flatchain = pd.DataFrame(samples, columns=var_names)
+    for k, name in enumerate(var_names):
+        params[name].value = np.median(samples[:, k])
+        params[name].stderr = np.std(samples[:, k])
+    params.update_constraints()
+
+    return fit_result
+
+
 
 
 
@@ -0,0 +1,198 @@
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from astrovoigtfit import fit_continuum, astro_voigt_fit
+
+
+# same settings as astrovoigtfit_run
+DEFAULT_FIT_KWARGS = {'v_resolution': 3, 'n_step': 25, 'std_dev': 0.0014}
+
+
+def job_key(job):
+    """Unique string identifying a (star, molecule, file_no, wave_range) job."""
+    return "{}|{}|{}|{}-{}".format(job['star'], ','.join(job['molecule']), job['file_no'],
+                                   job['wave_range'][0], job['wave_range'][1])
+
+
+def fit_job(job):
+    """
+    Run observations -> fit_continuum -> astro_voigt_fit for one job.
+
+    Parameters:
+    -----------
+    job : dict
+        'star', 'molecule' (list of species names), 'file_no', 'wave_range',
+        'absorption_range' and 'species_params' (initial b, N, v_rad guesses as
+        in read_inputs.py). Optional: 'species_file' (default 'species.txt'),
+        'degree' of the continuum polynomial (default 3) and 'fit_kwargs'
+        passed on to astro_voigt_fit (default DEFAULT_FIT_KWARGS).
+
+    Returns:
+    --------
+    record : dict
+        JSON serialisable summary of the fit: the job key, fitted parameter
+        values and errors, fit statistics, and the wave, normalised flux and
+        best fit arrays, and the 'profile' record of the fit if profiling was enabled.
+    """
+    # EDIBLES I/O is only needed in the workers
+    from main_run import observations, get_species_params
+
+    species_file = job.get('species_file', 'species.txt')
+    wave, flux = observations(job['star'], job['molecule'][0], job['file_no'],
+                              job['wave_range'], species_file)
+    species_params = get_species_params(species_file, dict(job['species_params']), job['molecule'])
+
+    continuum_normalized_flux, continuum, poly, std_dev = fit_continuum(
+        wave, flux, job['absorption_range'], job.get('degree', 3), return_std=True
+    )
+
+    fit_kwargs = dict(DEFAULT_FIT_KWARGS)
+    fit_kwargs.update(job.get('fit_kwargs', {}))
+    fitresult = astro_voigt_fit(
+        wavegrid=wave,
+        ydata=continuum_normalized_flux,
+        species_params=species_params,
+        **fit_kwargs
+    )
+
+    record = {'key': job_key(job)}
+    record.update(fit_record(fitresult))
+    record['continuum_std'] = float(std_dev)
+    record['wave'] = np.asarray(wave).tolist()
+    record['flux'] = np.asarray(continuum_normalized_flux).tolist()
+    return record
+
+
+def fit_record(fitresult):
+    """
+    JSON serialisable summary of an astro_voigt_fit result: the fitted parameter values and
+    errors, the fit statistics and the best fit, and its 'profile' record if profiling was
+    enabled.
+    """
+    record = {
+        'params': {name: par.value for name, par in fitresult.params.items()
+                   if par.vary or par.expr},
+        'stderr': {name: par.stderr for name, par in fitresult.params.items()
+                   if par.vary or par.expr},
+        'chisqr': fitresult.chisqr,
+        'redchi': fitresult.redchi,
+        'nfev': fitresult.nfev,
+        'success': bool(fitresult.success),
+        'best_fit': np.asarray(fitresult.best_fit).tolist(),
+    }
+    # with fit_kwargs={'profile': True}, see profiling.aggregate
+    if hasattr(fitresult, 'profile'):
+        record['profile'] = fitresult.profile
+    return record
+
+
+def _run_job(job):
+    # never let one failing job take down the whole batch
+    try:
+        return fit_job(job)
+    except Exception as e:
+        return {'key': job_key(job), 'error': f'{type(e).__name__}: {e}'}
+
+
+def _init_worker():
+    # one process per core: keep the numba kernels single threaded to avoid oversubscription.
+    # numba is only imported with its backends, so usually the environment variable is enough
+    if 'numba' in sys.modules:
+        sys.modules['numba'].set_num_threads(1)
+    else:
+        os.environ['NUMBA_NUM_THREADS'] = '1'
+
+
+def read_checkpoint(checkpoint):
+    """Completed records stored in a checkpoint file, keyed by job_key."""
+    done = {}
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            for line in f:
+                line = line.strip()
+                # a crash can leave a truncated last line
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                done[record['key']] = record
+    return done
+
+
+def _open_checkpoint(checkpoint):
+    # append mode, after ending a line truncated by a crash so that the next record is not lost
+    out = open(checkpoint, 'a+')
+    if out.tell() > 0:
+        out.seek(out.tell() - 1)
+        if out.read(1) != '\n':
+            out.write('\n')
+    return out
+
+
+def fit_many(jobs, n_workers=None, checkpoint=None, ordered=False):
+    """
+    Fit many (star, file_no, species, window) jobs in a process pool.
+
+    Results are yielded as soon as each job finishes (in completion order, not
+    job order), or with ordered=True in the order of jobs. With a checkpoint file, every successful record is appended to
+    it as one JSON line; when the batch is restarted, jobs already in the
+    checkpoint are not refitted and their stored records are yielded first.
+    Failed jobs are yielded with an 'error' entry and are not checkpointed, so
+    they are retried on the next run.
+
+    Parameters:
+    -----------
+    jobs : iterable of dict
+        Job descriptions, see fit_job
+    n_workers : int
+        Number of worker processes (default: number of CPUs)
+    checkpoint : str
+        Path of the JSON lines checkpoint file (optional)
+    ordered : bool
+        Yield the records in the order of jobs; finished jobs are still checkpointed
+        immediately, but are held back until all earlier jobs are done
+
+    Yields:
+    -------
+    record : dict
+        Fit summary as returned by fit_job
+    """
+    done = read_checkpoint(checkpoint)
+    jobs = list(jobs)
+    keys = [job_key(job) for job in jobs]
+    pending = [job for job, key in zip(jobs, keys) if key not in done]
+    next_job = 0  # with ordered, the first job whose record has not been yielded
+    if not ordered:
+        for key in keys:
+            if key in done:
+                yield done[key]
+
+    if pending:
+        out = _open_checkpoint(checkpoint) if checkpoint is not None else None
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as pool:
+                futures = [pool.submit(_run_job, job) for job in pending]
+                for future in as_completed(futures):
+                    record = future.result()
+                    if out is not None and 'error' not in record:
+                        out.write(json.dumps(record) + '\n')
+                        out.flush()
+                    if not ordered:
+                        yield record
+                        continue
+                    # release the records of the leading jobs that are now complete
+                    done[record['key']] = record
+                    while next_job < len(keys) and keys[next_job] in done:
+                        yield done[keys[next_job]]
+                        next_job += 1
+        finally:
+            if out is not None:
+                out.close()
+
+    if ordered:
+        for key in keys[next_job:]:
+            yield done[key]
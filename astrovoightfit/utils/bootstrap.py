@@ -0,0 +1,174 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from astrovoigtfit import _fit_plan, _species_parameters
+from batch_run import _init_worker
+from model import ContinuumPlan, JointPlan, ModelPlan
+
+
+# state of a bootstrap worker, set up once per process by _attach
+_worker = {}
+
+
+def fit_setup(result):
+    """
+    species_params (with the fitted b, N and v_rad) and ModelPlan keyword arguments of an
+    astro_voigt_fit result, from which the fit can be repeated on new data.
+    """
+    plan = result.userkws['plan']
+    if isinstance(plan, JointPlan):
+        raise ValueError('bootstrap_uncertainties needs an astro_voigt_fit result, not a joint fit')
+    continuum_degree = None
+    if isinstance(plan, ContinuumPlan):
+        continuum_degree = plan.degree
+        plan = plan.plan
+
+    params = result.params
+    species_params = {}
+    for s, i in plan.components:
+        if s not in species_params:
+            n_trans = int(params[f'n_trans_{s}'].value)
+            species_params[s] = {key: [params[f'{key}_{s}_{k}'].value for k in range(n_trans)]
+                                 for key in ('lambda', 'f', 'gamma')}
+            species_params[s].update(b=[], N=[], v_rad=[])
+        for key in ('b', 'N', 'v_rad'):
+            species_params[s][key].append(params[f'{key}_{s}_{i}'].value)
+
+    plan_kwargs = {'v_resolution': plan.v_resolution, 'n_step': plan.n_step, 'backend': plan.backend,
+                   'lsf': plan.operators.lsf, 'flux_tol': plan.flux_tol, 'max_memory': plan.max_memory}
+    return species_params, plan_kwargs, continuum_degree
+
+
+def _attach(shm_name, shape, species_params, plan_kwargs, continuum_degree, fit_kwargs):
+    # attach to the shared wavegrid, best fit, residuals and weights and build the plan once
+    shm = shared_memory.SharedMemory(name=shm_name)
+    wavegrid, best_fit, residual, weights = np.ndarray(shape, dtype=float, buffer=shm.buf)
+    _worker.update(shm=shm, wavegrid=wavegrid, best_fit=best_fit, residual=residual, weights=weights,
+                   species_params=species_params, continuum_degree=continuum_degree, fit_kwargs=fit_kwargs,
+                   plan=ModelPlan(wavegrid, species_params, **plan_kwargs))
+
+
+def _init_bootstrap_worker(*args):
+    _init_worker()
+    _attach(*args)
+
+
+def resample(residual, weights, rng, block_size=1):
+    """
+    Residuals drawn with replacement from residual, in blocks of block_size consecutive pixels
+    (moving block bootstrap, for noise correlated by the line spread function). The residuals
+    are resampled in units of their standard deviation (residual * weights), so pixels keep
+    their own noise level.
+    """
+    normalized = residual * weights
+    normalized = normalized - normalized.mean()
+    n_blocks = -(-residual.size // block_size)
+    starts = rng.integers(0, residual.size - block_size + 1, n_blocks)
+    index = (starts[:, None] + np.arange(block_size)).ravel()[:residual.size]
+    return normalized[index] / weights
+
+
+def _fit_replicate(task):
+    # one bootstrap fit, started from the best fit; returns theta or None if it failed
+    replicate, seed, block_size = task
+    rng = np.random.default_rng([seed, replicate])
+    ydata = _worker['best_fit'] + resample(_worker['residual'], _worker['weights'], rng, block_size)
+    plan = _worker['plan']
+    if _worker['continuum_degree'] is not None:
+        plan = ContinuumPlan(plan, ydata, _worker['weights'], degree=_worker['continuum_degree'])
+    params = _species_parameters({s: dict(species) for s, species in _worker['species_params'].items()},
+                                 _worker['plan'].v_resolution, _worker['plan'].n_step)
+    try:
+        result = _fit_plan(ydata, params, plan, _worker['weights'], **_worker['fit_kwargs'])
+    except Exception:
+        return None
+    if not result.success:
+        return None
+    return np.array([result.params[name].value for name in plan.param_names])
+
+
+def bootstrap_uncertainties(result, n_boot=200, n_workers=None, percentiles=(15.87, 84.13), seed=0,
+                            block_size=1, jacobian='analytic', max_nfev=None):
+    """
+    Bootstrap uncertainties of the b, N and v_rad of an astro_voigt_fit result by residual
+    resampling.
+
+    Every replicate refits best_fit + resampled residuals (see resample), starting from the
+    best fit. The replicates run in a process pool; the wavegrid, best fit, residuals and
+    weights are placed in shared memory once and every worker builds its ModelPlan once, so a
+    task only sends its replicate number. Unlike the covariance errors of result.params, the
+    intervals need not be symmetric, and stay meaningful for saturated lines and strongly
+    correlated b and N.
+
+    Parameters:
+    -----------
+    result : lmfit.model.ModelResult
+        Result of astro_voigt_fit (also with continuum_degree)
+    n_boot : int
+        Number of bootstrap replicates
+    n_workers : int
+        Number of worker processes (default: number of CPUs); 1 fits in this process
+    percentiles : tuple
+        Percentiles of the replicates given as the interval of every parameter
+        (default: the 1 sigma equivalent 15.87 and 84.13)
+    seed : int
+        Seed of the resampling; replicate k uses default_rng([seed, k]), so the result does
+        not depend on n_workers
+    block_size : int
+        Length of the resampled blocks of residuals, see resample
+    jacobian, max_nfev :
+        As for astro_voigt_fit, used for the replicate fits
+
+    Returns:
+    --------
+    bootstrap : dict
+        'intervals' (parameter name -> tuple of the percentiles), 'median' and 'std' of every
+        b_<s>_<i>, N_<s>_<i> and v_rad_<s>_<i>, the replicate parameter values in 'samples'
+        (n_converged x n_parameters, columns in the order of 'param_names') and the number
+        of replicate fits that failed or did not converge in 'n_failed'
+    """
+    species_params, plan_kwargs, continuum_degree = fit_setup(result)
+    fit_kwargs = {'jacobian': jacobian, 'max_nfev': max_nfev}
+    param_names = list(result.userkws['plan'].param_names)
+
+    wavegrid = np.asarray(result.userkws['wavegrid'], dtype=float)
+    arrays = np.stack([wavegrid, result.best_fit, result.data - result.best_fit,
+                       np.broadcast_to(np.asarray(result.weights, dtype=float), wavegrid.shape)])
+    shm = shared_memory.SharedMemory(create=True, size=arrays.nbytes)
+    try:
+        np.ndarray(arrays.shape, dtype=float, buffer=shm.buf)[:] = arrays
+        initargs = (shm.name, arrays.shape, species_params, plan_kwargs, continuum_degree, fit_kwargs)
+        tasks = [(k, seed, block_size) for k in range(n_boot)]
+        if n_workers == 1:
+            _attach(*initargs)
+            try:
+                thetas = list(map(_fit_replicate, tasks))
+            finally:
+                worker_shm = _worker['shm']
+                _worker.clear()
+                worker_shm.close()
+        else:
+            chunksize = max(1, n_boot // (4 * (n_workers or os.cpu_count())))
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_bootstrap_worker,
+                                     initargs=initargs) as pool:
+                thetas = list(pool.map(_fit_replicate, tasks, chunksize=chunksize))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    converged = [theta for theta in thetas if theta is not None]
+    if not converged:
+        raise RuntimeError(f'None of the {n_boot} bootstrap fits converged')
+    samples = np.array(converged)
+    low_high = np.percentile(samples, percentiles, axis=0)
+    return {
+        'param_names': param_names,
+        'samples': samples,
+        'intervals': {name: tuple(float(p) for p in low_high[:, k]) for k, name in enumerate(param_names)},
+        'median': dict(zip(param_names, np.median(samples, axis=0).tolist())),
+        'std': dict(zip(param_names, np.std(samples, axis=0).tolist())),
+        'n_failed': n_boot - len(converged),
+    }
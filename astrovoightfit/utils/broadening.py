@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from other_functions import C_KMS, fwhm2sigma
+
+
+def _support_pairs(wavegrid, refgrid, u_min, u_max):
+    # (row, col) pairs of every refgrid pixel within [u_min, u_max] km/s of every wavegrid pixel,
+    # and the velocity offset u of the refgrid pixel
+    start = np.searchsorted(refgrid, wavegrid * (1.0 + u_min / C_KMS), side="left")
+    stop = np.searchsorted(refgrid, wavegrid * (1.0 + u_max / C_KMS), side="right")
+    counts = stop - start
+    row = np.repeat(np.arange(wavegrid.size), counts)
+    col = np.repeat(start, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    u = (refgrid[col] / wavegrid[row] - 1.0) * C_KMS
+    return row, col, u
+
+
+def _normalised_operator(row, col, values, shape):
+    # every row sums to one, so that a flat spectrum stays flat
+    norm = np.bincount(row, weights=values, minlength=shape[0])
+    values = np.divide(values, norm[row], out=np.zeros(values.size), where=norm[row] > 0)
+    return sparse.csr_matrix((values, (row, col)), shape=shape)
+
+
+def gaussian_operator(wavegrid, refgrid, v_resolution, truncate=4.0):
+    """
+    Sparse (len(wavegrid) x len(refgrid)) operator convolving with a Gaussian of FWHM
+    v_resolution (km/s) and sampling the result at wavegrid.
+
+    This replaces gaussian_filter followed by np.interp in mother_function. The kernel is
+    evaluated at the exact velocity offset between every wavegrid pixel and the refgrid
+    pixels within +/- truncate sigma, so there is no linear interpolation error.
+    """
+    sigma = fwhm2sigma(v_resolution)
+    row, col, u = _support_pairs(wavegrid, refgrid, -truncate * sigma, truncate * sigma)
+    return _normalised_operator(row, col, np.exp(-0.5 * (u / sigma) ** 2), (wavegrid.size, refgrid.size))
+
+
+def tabulated_operator(wavegrid, refgrid, lsf):
+    """
+    Sparse (len(wavegrid) x len(refgrid)) operator convolving with a tabulated, wavelength
+    dependent line spread function and sampling the result at wavegrid.
+
+    lsf is a tuple (lsf_wave, lsf_velocity, lsf_kernel): the LSF profile lsf_kernel[i] is
+    tabulated against velocity offsets lsf_velocity (km/s, sorted) at wavelength lsf_wave[i]
+    (sorted). The profile at every wavegrid pixel is linearly interpolated between the nodes
+    (and held constant beyond them), and every row is normalised to unit sum.
+    """
+    lsf_wave, lsf_velocity, lsf_kernel = (np.asarray(x, dtype=float) for x in lsf)
+    lsf_wave = np.atleast_1d(lsf_wave)
+    lsf_kernel = np.atleast_2d(lsf_kernel)
+    row, col, u = _support_pairs(wavegrid, refgrid, lsf_velocity[0], lsf_velocity[-1])
+
+    # bilinear interpolation of the table in (wavelength, velocity)
+    node = np.clip(np.searchsorted(lsf_wave, wavegrid, side="right") - 1, 0, max(lsf_wave.size - 2, 0))
+    node_next = np.minimum(node + 1, lsf_wave.size - 1)
+    span = lsf_wave[node_next] - lsf_wave[node]
+    tw = np.clip(np.divide(wavegrid - lsf_wave[node], span, out=np.zeros(wavegrid.size), where=span > 0), 0, 1)
+
+    q = np.clip(np.searchsorted(lsf_velocity, u, side="right") - 1, 0, lsf_velocity.size - 2)
+    tu = (u - lsf_velocity[q]) / (lsf_velocity[q + 1] - lsf_velocity[q])
+    a, b = node[row], node_next[row]
+    kernel_a = (1.0 - tu) * lsf_kernel[a, q] + tu * lsf_kernel[a, q + 1]
+    kernel_b = (1.0 - tu) * lsf_kernel[b, q] + tu * lsf_kernel[b, q + 1]
+    values = (1.0 - tw[row]) * kernel_a + tw[row] * kernel_b
+
+    return _normalised_operator(row, col, values, (wavegrid.size, refgrid.size))
+
+
+class OperatorCache:
+    """
+    Least recently used cache of instrument-broadening + resampling operators.
+
+    The operator only depends on the observed grid, the reference grid (start, step and
+    size) and the resolution, so during a fit the few distinct reference grids each build
+    their operator once. With lsf=None the kernel is the Gaussian of v_resolution (FWHM),
+    otherwise the tabulated LSF (see tabulated_operator).
+    """
+
+    def __init__(self, lsf=None, maxsize=8):
+        self.lsf = lsf
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._operators = OrderedDict()
+
+    def get(self, wavegrid, refgrid, v_stepsize, v_resolution):
+        key = (wavegrid.size, hash(wavegrid.tobytes()), refgrid.size, refgrid[0], v_stepsize, v_resolution)
+        operator = self._operators.get(key)
+        if operator is not None:
+            self.hits += 1
+            self._operators.move_to_end(key)
+            return operator
+
+        self.misses += 1
+        if self.lsf is None:
+            operator = gaussian_operator(wavegrid, refgrid, v_resolution)
+        else:
+            operator = tabulated_operator(wavegrid, refgrid, self.lsf)
+        self._operators[key] = operator
+        if len(self._operators) > self.maxsize:
+            self._operators.popitem(last=False)
+        return operator
@@ -0,0 +1,161 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.polynomial import Chebyshev
+
+from astrovoigtfit import astro_voigt_fit
+from batch_run import _init_worker
+from other_functions import C_KMS, line_peak_tau
+
+
+def residual_troughs(residual, n_troughs):
+    """Indices of the n_troughs deepest local minima of residual (data - model)."""
+    inner = np.flatnonzero((residual[1:-1] < residual[:-2]) & (residual[1:-1] <= residual[2:])) + 1
+    return inner[np.argsort(residual[inner])][:n_troughs]
+
+
+def add_component(species_params, v_rad, wavegrid, residual, b=2.0):
+    """
+    Copy of species_params with one more velocity component at v_rad in every species.
+
+    The N guess of every species follows from the depth of residual at its strongest
+    transition (largest f), shifted to v_rad. The new components all have the same v_rad,
+    so astro_voigt_fit ties them to one master v_rad parameter.
+    """
+    new = copy.deepcopy(species_params)
+    for s, species in new.items():
+        lambdas = np.atleast_1d(np.asarray(species['lambda'], dtype=float))
+        f = np.atleast_1d(np.asarray(species['f'], dtype=float))
+        gamma = np.atleast_1d(np.asarray(species['gamma'], dtype=float))
+        k = np.argmax(f)
+        depth = -np.interp(lambdas[k] * (1.0 + v_rad / C_KMS), wavegrid, residual)
+        tau = -np.log1p(-np.clip(depth, 1e-3, 0.9))
+        N = tau / line_peak_tau(lambdas[k], f[k], gamma[k], b, 1.0)
+        for key, value in (('b', b), ('N', N), ('v_rad', v_rad)):
+            species[key] = list(np.atleast_1d(species.get(key, []))) + [float(value)]
+    return new
+
+
+def candidate_velocities(species_params, wavegrid, residual, n_troughs=3, v_max=50.0):
+    """
+    v_rad of a new component for every pair of residual trough and species (strongest
+    transition), within +/- v_max km/s and at least 1 km/s apart.
+    """
+    velocities = []
+    for pixel in residual_troughs(residual, n_troughs):
+        for species in species_params.values():
+            k = np.argmax(species['f'])
+            v = (wavegrid[pixel] / np.atleast_1d(species['lambda'])[k] - 1.0) * C_KMS
+            if abs(v) <= v_max and all(abs(v - other) >= 1.0 for other in velocities):
+                velocities.append(float(v))
+    return velocities
+
+
+def _fit_candidate(args):
+    # one fit; the fitted b, N and v_rad are sent back as a species_params dict, with the
+    # residual of the normalised spectrum (divided by the fitted continuum, if any)
+    wavegrid, ydata, species_params, fit_kwargs = args
+    try:
+        result = astro_voigt_fit(wavegrid, ydata, copy.deepcopy(species_params), **fit_kwargs)
+    except Exception as e:
+        return {'chisqr': np.inf, 'error': f'{type(e).__name__}: {e}'}
+    fitted = copy.deepcopy(species_params)
+    for s, species in fitted.items():
+        for key in ('b', 'N', 'v_rad'):
+            species[key] = [result.params[f'{key}_{s}_{i}'].value for i in range(len(species['v_rad']))]
+    residual = ydata - result.best_fit
+    if hasattr(result, 'continuum'):
+        residual = residual / result.continuum
+    return {'chisqr': float(result.chisqr), 'aic': float(result.aic), 'bic': float(result.bic),
+            'species_params': fitted, 'residual': residual}
+
+
+def astro_voigt_autocomponents(wavegrid, ydata, species_params, max_components=4, criterion='bic',
+                               n_troughs=3, v_max=50.0, patience=1, candidate_max_nfev=1000, n_workers=None,
+                               **fit_kwargs):
+    """
+    Fit 1 .. max_components velocity components and pick the number by BIC or AIC.
+
+    The components are shared by all species (as the tied v_rad parameters of
+    astro_voigt_fit). Every (k+1)-component fit starts from the best k-component solution
+    plus a new component placed at one of the deepest troughs of its residual
+    (see candidate_velocities); the residual is that of the fit itself, so with
+    continuum_degree it is measured against the fitted continuum (before the first
+    component, against a Chebyshev polynomial fitted to all of ydata). These candidate placements are fitted concurrently in a
+    process pool and the best one is kept, so every extra component costs about the wall
+    time of one fit. The search stops after patience components that do not improve the
+    criterion.
+
+    Parameters:
+    -----------
+    wavegrid, ydata :
+        As for astro_voigt_fit
+    species_params : dict
+        As for astro_voigt_fit; only 'lambda', 'f' and 'gamma' are used
+    max_components : int
+        Largest number of components tried
+    criterion : str
+        'bic' or 'aic'
+    n_troughs : int
+        Number of residual troughs tried for every new component
+    v_max : float
+        Largest |v_rad| (km/s) of a new component
+    patience : int
+        Number of components without improvement after which the search stops
+    candidate_max_nfev : int
+        max_nfev of the candidate fits, so that a poor placement that does not converge
+        does not hold up the search (the selected fit is refitted without this limit)
+    n_workers : int
+        Number of worker processes (default: number of CPUs); 1 fits in this process
+    **fit_kwargs :
+        Passed on to astro_voigt_fit (v_resolution, std_dev, backend, jacobian, ...)
+
+    Returns:
+    --------
+    result : lmfit.model.ModelResult
+        Fit with the selected number of components; result.component_selection lists
+        n_components, chisqr, aic, bic and the fitted species_params of the best fit
+        at every number of components tried
+    """
+    if criterion not in ('bic', 'aic'):
+        raise ValueError(f"Unknown criterion '{criterion}', use 'bic' or 'aic'")
+
+    wavegrid = np.asarray(wavegrid, dtype=float)
+    ydata = np.asarray(ydata, dtype=float)
+    current = {s: {key: species[key] for key in ('lambda', 'f', 'gamma')}
+               for s, species in species_params.items()}
+    if fit_kwargs.get('continuum_degree') is None:
+        residual = ydata - 1.0
+    else:
+        residual = ydata / Chebyshev.fit(wavegrid, ydata, fit_kwargs['continuum_degree'])(wavegrid) - 1.0
+    levels = []
+    candidate_kwargs = dict({'max_nfev': candidate_max_nfev}, **fit_kwargs)
+
+    pool = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) if n_workers != 1 else None
+    try:
+        for n_components in range(1, max_components + 1):
+            velocities = candidate_velocities(current, wavegrid, residual, n_troughs, v_max)
+            if not velocities:
+                break
+            tasks = [(wavegrid, ydata, add_component(current, v, wavegrid, residual), candidate_kwargs)
+                     for v in velocities]
+            fits = list(pool.map(_fit_candidate, tasks)) if pool is not None else list(map(_fit_candidate, tasks))
+            best = min(fits, key=lambda fit: fit['chisqr'])
+            if 'error' in best:
+                raise RuntimeError(f"All fits with {n_components} components failed: {best['error']}")
+            residual = best.pop('residual')
+            levels.append(dict(best, n_components=n_components))
+            current = best['species_params']
+
+            selected = min(levels, key=lambda level: level[criterion])
+            if n_components - selected['n_components'] >= patience:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    selected = min(levels, key=lambda level: level[criterion])
+    result = astro_voigt_fit(wavegrid, ydata, copy.deepcopy(selected['species_params']), **fit_kwargs)
+    result.component_selection = levels
+    return result
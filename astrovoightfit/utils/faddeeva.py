@@ -0,0 +1,78 @@
+import numpy as np
+from scipy.special import wofz
+
+
+# Maximum relative error of Re[w(z)] against scipy.special.wofz, measured on
+# x in [-100, 100], y in [1e-6, 100] (y >= 0 only).
+BACKEND_MAX_REL_ERROR = {
+    "scipy": 0.0,
+    "humlicek": 1.0e-4,
+    "weideman": 3.0e-6,
+    # see voigt_table.TABLE_MAX_REL_ERROR
+    "table": 5.0e-7,
+}
+
+# Weideman (1994) rational expansion with N = 32 terms
+_WEIDEMAN_N = 32
+_WEIDEMAN_L = np.sqrt(_WEIDEMAN_N / np.sqrt(2))
+
+
+def _weideman_coefficients(n, L):
+    m = 2 * n
+    k = np.arange(-m + 1, m)
+    t = L * np.tan(k * np.pi / m / 2)
+    f = np.concatenate(([0.0], np.exp(-t ** 2) * (L ** 2 + t ** 2)))
+    a = np.real(np.fft.fft(np.fft.fftshift(f))) / (2 * m)
+    # highest order first, as needed for Horner's scheme
+    return np.ascontiguousarray(a[1:n + 1][::-1])
+
+
+_WEIDEMAN_A = _weideman_coefficients(_WEIDEMAN_N, _WEIDEMAN_L)
+
+
+def faddeeva(x, y, backend="scipy"):
+    """
+    Function to return the real and imaginary part of the Faddeeva function w(z), z = x + iy,
+    for real arrays x and y (y >= 0).
+
+    The "humlicek" and "weideman" backends are compiled with numba and run multi-threaded over
+    the input; they trade accuracy for speed. BACKEND_MAX_REL_ERROR lists the maximum relative
+    error of Re[w] of every backend against scipy.special.wofz.
+
+    Args:
+        x (float64): Scalar or array of real parts of z
+        y (float64): Scalar or array of imaginary parts of z (y >= 0)
+        backend (str): "scipy", "humlicek", "weideman" or "table" (voigt_table)
+
+    Returns:
+        tuple: (Re[w], Im[w]) as float64 arrays with the broadcast shape of x and y
+
+    """
+
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+    if backend == "scipy":
+        w = wofz(x + 1j * y)
+        return np.real(w), np.imag(w)
+
+    if backend == "table":
+        # tabulated H(a, u), see voigt_table
+        from voigt_table import default_table
+        return default_table().faddeeva(x, y)
+
+    shape = x.shape
+    x = np.ascontiguousarray(x).ravel()
+    y = np.ascontiguousarray(y).ravel()
+    re = np.empty(x.size)
+    im = np.empty(x.size)
+
+    if backend == "humlicek":
+        from faddeeva_kernels import _humlicek_kernel
+        _humlicek_kernel(x, y, re, im)
+    elif backend == "weideman":
+        from faddeeva_kernels import _weideman_kernel
+        _weideman_kernel(x, y, _WEIDEMAN_A, _WEIDEMAN_L, re, im)
+    else:
+        raise ValueError(f"Unknown Faddeeva backend '{backend}', use one of {list(BACKEND_MAX_REL_ERROR)}")
+
+    return re.reshape(shape), im.reshape(shape)
@@ -0,0 +1,66 @@
+"""
+numba kernels of the "humlicek" and "weideman" Faddeeva backends.
+
+Importing numba (and compiling the kernels) takes a noticeable time, so faddeeva only imports
+this module on the first use of one of these backends.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, fall back to plain python loops
+    prange = range
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True)
+def _humlicek_w4(x, y):
+    # Humlicek (1982) W4 four-region rational approximation, valid for y >= 0
+    t = complex(y, -x)
+    s = abs(x) + y
+    if s >= 15.0:
+        w = t * 0.5641896 / (0.5 + t * t)
+    elif s >= 5.5:
+        u = t * t
+        w = t * (1.410474 + u * 0.5641896) / (0.75 + u * (3.0 + u))
+    elif y >= 0.195 * abs(x) - 0.176:
+        w = (16.4955 + t * (20.20933 + t * (11.96482 + t * (3.778987 + t * 0.5642236)))) / (
+            16.4955 + t * (38.82363 + t * (39.27121 + t * (21.69274 + t * (6.699398 + t)))))
+    else:
+        u = t * t
+        w = np.exp(u) - t * (36183.31 - u * (3321.9905 - u * (1540.787 - u * (
+            219.0313 - u * (35.76683 - u * (1.320522 - u * 0.56419)))))) / (
+            32066.6 - u * (24322.84 - u * (9022.228 - u * (2186.181 - u * (
+                364.2191 - u * (61.57037 - u * (1.841439 - u)))))))
+    return w
+
+
+@njit(cache=True)
+def _weideman_w(x, y, a, L):
+    # Weideman (1994) rational expansion, valid for y >= 0
+    iz = complex(-y, x)
+    Z = (L + iz) / (L - iz)
+    p = 0j
+    for coefficient in a:
+        p = p * Z + coefficient
+    return 2.0 * p / (L - iz) ** 2 + 0.5641895835477563 / (L - iz)
+
+
+@njit(parallel=True, cache=True)
+def _humlicek_kernel(x, y, re, im):
+    for i in prange(x.size):
+        w = _humlicek_w4(x[i], y[i])
+        re[i] = w.real
+        im[i] = w.imag
+
+
+@njit(parallel=True, cache=True)
+def _weideman_kernel(x, y, a, L, re, im):
+    for i in prange(x.size):
+        w = _weideman_w(x[i], y[i], a, L)
+        re[i] = w.real
+        im[i] = w.imag
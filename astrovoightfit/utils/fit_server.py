@@ -0,0 +1,255 @@
+"""
+Long-lived local fitting service.
+
+The service imports the fitting code once, loads the line catalog, compiles the numba kernels
+with a small warm-up fit and then answers JSON requests over HTTP on localhost, so every fit
+only pays for the fit itself. The line catalog and the observation lists (see
+observation_cache) stay in memory between requests; observation windows are read from the
+observation_cache files on disk.
+
+Endpoints (POST, JSON body and response):
+    /fit        astro_voigt_fit: 'wavegrid', 'ydata', 'species_params' and the keyword
+                arguments of astro_voigt_fit (see FIT_KWARGS); returns batch_run.fit_record
+    /continuum  fit_continuum: 'wavelength', 'flux', 'absorption_range' and 'degree'
+    /job        the whole pipeline of batch_run.fit_job for a (star, molecule, file_no, ...) job
+and GET /health for the queue state. At most n_workers requests run at once and at most
+max_queue wait; further requests get HTTP 503.
+
+The service has no authentication. It only listens on a loopback address unless started with
+--allow-remote, and /job always uses the line catalog given at start-up (--species-file):
+a request cannot name another catalog file.
+
+Usage:
+    python fit_server.py --port 8765 --workers 2
+
+    from fit_server import request
+    record = request('/fit', {'wavegrid': wave, 'ydata': flux, 'species_params': species_params,
+                              'v_resolution': 3, 'std_dev': 0.0014})
+"""
+import argparse
+import ipaddress
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from astrovoigtfit import astro_voigt_fit, fit_continuum
+from batch_run import fit_job, fit_record
+from line_catalog import load_catalog
+from model import master_function
+
+
+DEFAULT_URL = 'http://127.0.0.1:8765'
+
+# keyword arguments of astro_voigt_fit accepted by /fit (profile is not thread safe)
+FIT_KWARGS = ('v_resolution', 'n_step', 'std_dev', 'backend', 'jacobian', 'lsf', 'flux_tol',
+              'max_nfev', 'max_memory', 'continuum_degree', 'store_key')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FitService:
+    """
+    Runs the requests of the server in a pool of n_workers threads, with at most max_queue
+    requests waiting. Threads share the in-memory caches (line catalog, observation windows)
+    and the compiled kernels.
+    """
+
+    def __init__(self, n_workers=2, max_queue=16, species_file='species.txt'):
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.species_file = species_file
+        self.pool = ThreadPoolExecutor(max_workers=n_workers)
+        self.pending = 0
+        self.served = 0
+        self._lock = threading.Lock()
+        self.handlers = {'/fit': self.fit, '/continuum': self.continuum, '/job': self.job}
+
+    def warm_up(self, backends=('scipy',)):
+        """Load the line catalog and run a small fit with every backend (numba compilation)."""
+        load_catalog(self.species_file)
+        wavegrid = np.linspace(4231.5, 4233.5, 200)
+        ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                                gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[0.0])
+        for backend in backends:
+            species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.5], 'N': [5e12],
+                           'v_rad': [1.0]}}
+            astro_voigt_fit(wavegrid, ydata, species, v_resolution=3.0, backend=backend, jacobian='analytic')
+
+    def submit(self, path, payload):
+        """Run the handler of path on payload in the pool and wait for its result."""
+        handler = self.handlers[path]
+        with self._lock:
+            if self.pending >= self.n_workers + self.max_queue:
+                raise QueueFull(f'{self.pending} requests pending')
+            self.pending += 1
+        try:
+            return self.pool.submit(handler, payload).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.served += 1
+
+    def health(self):
+        return {'status': 'ok', 'pending': self.pending, 'served': self.served,
+                'n_workers': self.n_workers, 'max_queue': self.max_queue}
+
+    def fit(self, payload):
+        unknown = set(payload) - {'wavegrid', 'ydata', 'species_params'} - set(FIT_KWARGS)
+        if unknown:
+            raise ValueError(f'Unknown fit arguments: {sorted(unknown)}')
+        kwargs = {name: payload[name] for name in FIT_KWARGS if name in payload}
+        if 'std_dev' in kwargs and not np.isscalar(kwargs['std_dev']):
+            kwargs['std_dev'] = np.asarray(kwargs['std_dev'], dtype=float)
+        if kwargs.get('lsf') is not None:
+            kwargs['lsf'] = tuple(np.asarray(table, dtype=float) for table in kwargs['lsf'])
+        if 'store_key' in kwargs:
+            star, file, species, wave_range = kwargs['store_key']
+            kwargs['store_key'] = (star, file, tuple(species), tuple(wave_range))
+
+        result = astro_voigt_fit(np.asarray(payload['wavegrid'], dtype=float),
+                                 np.asarray(payload['ydata'], dtype=float),
+                                 _species_params(payload['species_params']), **kwargs)
+        record = fit_record(result)
+        record['culled_lines'] = result.culled_lines
+        for name in ('warm_start', 'continuum'):
+            if hasattr(result, name):
+                record[name] = getattr(result, name)
+        return record
+
+    def continuum(self, payload):
+        normalized_flux, continuum, poly, std = fit_continuum(
+            np.asarray(payload['wavelength'], dtype=float), np.asarray(payload['flux'], dtype=float),
+            payload['absorption_range'], payload.get('degree', 3), return_std=True)
+        return {'normalized_flux': normalized_flux, 'continuum': continuum,
+                'coefficients': poly.coef, 'domain': poly.domain, 'std': std}
+
+    def job(self, payload):
+        # the catalog is read, and its .npz cache written, next to species_file, so clients
+        # must not choose the path
+        if 'species_file' in payload:
+            raise ValueError('species_file cannot be set by a request; the service uses '
+                             f'{self.species_file!r} (--species-file)')
+        unknown = set(payload.get('fit_kwargs', {})) - set(FIT_KWARGS)
+        if unknown:
+            raise ValueError(f'Unknown fit arguments: {sorted(unknown)}')
+        job = dict(payload)
+        job['species_file'] = self.species_file
+        job['species_params'] = _species_params(job['species_params'])
+        return fit_job(job)
+
+
+def _species_params(species_params):
+    # JSON object keys are strings; astro_voigt_fit uses the integer species indices
+    return {int(s) if str(s).isdigit() else s: dict(species) for s, species in species_params.items()}
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serialisable')
+
+
+class FitRequestHandler(BaseHTTPRequestHandler):
+    service = None  # FitService, set by make_server
+
+    def _reply(self, status, body):
+        data = json.dumps(body, default=_json_default).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, self.service.health())
+        else:
+            self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path not in self.service.handlers:
+            self._reply(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        try:
+            body = self.service.submit(self.path, json.loads(payload or b'{}'))
+            body['seconds'] = time.perf_counter() - start
+            self._reply(200, body)
+        except QueueFull as e:
+            self._reply(503, {'error': f'Queue full: {e}'})
+        except Exception as e:
+            self._reply(400, {'error': f'{type(e).__name__}: {e}'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def is_loopback(host):
+    """True if host is localhost or a loopback IP address."""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_server(host='127.0.0.1', port=8765, service=None, allow_remote=False):
+    """
+    HTTP server answering the requests with service (a FitService); port 0 picks a free port.
+    The service has no authentication, so a host other than a loopback address is refused
+    unless allow_remote is set.
+    """
+    if not allow_remote and not is_loopback(host):
+        raise ValueError(f'Refusing to listen on {host!r} without allow_remote (--allow-remote): '
+                         'the service has no authentication')
+    handler = type('Handler', (FitRequestHandler,), {'service': service or FitService()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def request(path, payload=None, url=DEFAULT_URL, timeout=600):
+    """Send payload to the endpoint path of a running service and return its JSON reply."""
+    data = None if payload is None else json.dumps(payload, default=_json_default).encode()
+    req = urllib.request.Request(url + path, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f'{e.code}: {json.loads(e.read()).get("error")}') from None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='allow a --host other than a loopback address (no authentication!)')
+    parser.add_argument('--workers', type=int, default=2, help='fits running at once')
+    parser.add_argument('--queue', type=int, default=16, help='requests waiting before 503')
+    parser.add_argument('--species-file', default='species.txt')
+    parser.add_argument('--backend', action='append', default=None,
+                        help='Faddeeva backends to compile at start-up (default scipy)')
+    args = parser.parse_args()
+
+    service = FitService(args.workers, args.queue, args.species_file)
+    service.warm_up(args.backend or ('scipy',))
+    server = make_server(args.host, args.port, service, allow_remote=args.allow_remote)
+    print(f'astrovoigtfit service on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown()
@@ -0,0 +1,106 @@
+import copy
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+
+# SQLite file holding the fitted b, N and v_rad of earlier fits
+STORE_PATH = os.environ.get(
+    "ASTROVOIGTFIT_STORE",
+    os.path.join(os.path.expanduser("~"), ".cache", "astrovoigtfit", "fits.sqlite"),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    star TEXT NOT NULL,
+    file TEXT NOT NULL,
+    species TEXT NOT NULL,
+    wave_min REAL NOT NULL,
+    wave_max REAL NOT NULL,
+    created REAL NOT NULL,
+    success INTEGER NOT NULL,
+    chisqr REAL,
+    redchi REAL,
+    params TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fits_target ON fits (star, species, wave_min, wave_max);
+"""
+
+
+def _connect(path):
+    path = STORE_PATH if path is None else path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30.0)
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def _key_values(key):
+    # (star, file, species, wave_range) -> column values
+    star, file, species, wave_range = key
+    return str(star), str(file), json.dumps([str(s) for s in species]), float(wave_range[0]), float(wave_range[1])
+
+
+def record_fit(key, result, species_params, path=None):
+    """
+    Store the fitted b, N and v_rad of result under key = (star, file, species, wave_range),
+    where file identifies the exposure and species is the tuple of species names in the
+    order of species_params.
+    """
+    solution = {
+        str(s): {name: [float(result.params[f'{name}_{s}_{i}'].value)
+                        for i in range(np.size(species_params[s]['v_rad']))]
+                 for name in ('b', 'N', 'v_rad')}
+        for s in species_params
+    }
+    with _connect(path) as connection:
+        connection.execute(
+            "INSERT INTO fits (star, file, species, wave_min, wave_max, created, success, chisqr, redchi, params)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            _key_values(key) + (time.time(), int(bool(result.success)), float(result.chisqr),
+                                float(result.redchi), json.dumps(solution)))
+    connection.close()
+
+
+def latest_solution(key, path=None):
+    """
+    The most recent converged solution for key, as (solution, source): solution maps every
+    species index (as a string) to its stored b, N and v_rad lists, source is 'exact' for the
+    same exposure or 'neighbour' for the same star, species and wavelength range in another
+    exposure. (None, None) if there is neither.
+    """
+    star, file, species, wave_min, wave_max = _key_values(key)
+    if not os.path.exists(STORE_PATH if path is None else path):
+        return None, None
+    with _connect(path) as connection:
+        row = connection.execute(
+            "SELECT params, file = ? FROM fits WHERE star = ? AND species = ? AND wave_min = ? AND wave_max = ?"
+            " AND success = 1 ORDER BY file = ? DESC, created DESC, id DESC LIMIT 1",
+            (file, star, species, wave_min, wave_max, file)).fetchone()
+    connection.close()
+    if row is None:
+        return None, None
+    return json.loads(row[0]), 'exact' if row[1] else 'neighbour'
+
+
+def seed(species_params, key, path=None):
+    """
+    Copy of species_params with b, N and v_rad replaced by the latest stored solution for key
+    (see latest_solution), and the source of the values. Species whose number of components
+    differs from the stored solution keep their own guesses.
+    """
+    solution, source = latest_solution(key, path)
+    seeded = copy.deepcopy(species_params)
+    if solution is None:
+        return seeded, None
+
+    for s in seeded:
+        stored = solution.get(str(s))
+        if stored is not None and len(stored['v_rad']) == np.size(seeded[s]['v_rad']):
+            for name in ('b', 'N', 'v_rad'):
+                seeded[s][name] = list(stored[name])
+    return seeded, source
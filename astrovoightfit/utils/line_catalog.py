@@ -0,0 +1,209 @@
+import csv
+import os
+import re
+
+import numpy as np
+
+
+# one row per transition, sorted by (species, wavelength)
+CATALOG_DTYPE = np.dtype([
+    ('species', 'U32'),
+    ('line', 'f8'),        # reference wavelength of the species (the 'line' column of species.txt)
+    ('wavelength', 'f8'),  # Angstrom
+    ('f', 'f8'),
+    ('gamma', 'f8'),
+])
+
+
+def _tokens(line):
+    # whitespace separated tokens, keeping bracketed lists such as "[ 0.4982,0.2491]" together
+    return re.findall(r'\[.*?\]|\S+', line)
+
+
+def _parse_values(token):
+    return [float(x) for x in token.strip('[]').split(',') if x.strip()]
+
+
+def read_species_file(path):
+    """
+    Read a species.txt style table (columns species, line, lambda, f_value and gamma, the last
+    three as bracketed lists) into a structured array with one row per transition.
+    """
+    rows = []
+    with open(path) as f:
+        headers = f.readline().split()
+        for line in f:
+            if not line.strip():
+                continue
+            columns = dict(zip(headers, _tokens(line)))
+            lambdas = _parse_values(columns['lambda'])
+            f_values = _parse_values(columns['f_value'])
+            gammas = _parse_values(columns['gamma'])
+            if not len(lambdas) == len(f_values) == len(gammas):
+                raise ValueError(f"Line for species {columns['species']} has lists of different lengths: {line!r}")
+            line_value = _parse_values(columns['line'])[0] if 'line' in columns else lambdas[0]
+            rows.extend((columns['species'], line_value, l, f_value, gamma)
+                        for l, f_value, gamma in zip(lambdas, f_values, gammas))
+    return np.array(rows, dtype=CATALOG_DTYPE)
+
+
+def read_delimited(path, columns, species=None, delimiter=',', wavenumber=False):
+    """
+    Read a delimited transition table with a header row, such as a VALD or HITRAN export
+    saved as CSV, into a structured array with one row per transition.
+
+    Parameters:
+    -----------
+    path : str
+        Table file
+    columns : dict
+        Header name of every catalog field: 'wavelength' (Angstrom, or cm^-1 with
+        wavenumber=True), 'gamma', and either 'f' or 'log_gf' with 'g_lower'
+        (f = 10**log_gf / g_lower). Optional: 'species' and 'line'.
+    species : str
+        Species name of every row, if the table has no species column
+    delimiter : str
+        Column delimiter
+    wavenumber : bool
+        The wavelength column holds vacuum wavenumbers in cm^-1
+
+    Returns:
+    --------
+    rows : numpy structured array
+        Transitions with dtype CATALOG_DTYPE
+    """
+    with open(path, newline='') as f:
+        table = [{key.strip(): value for key, value in row.items()}
+                 for row in csv.DictReader(f, delimiter=delimiter)]
+
+    def column(field):
+        return np.array([float(row[columns[field]]) for row in table])
+
+    wavelength = column('wavelength')
+    if wavenumber:
+        wavelength = 1e8 / wavelength
+    if 'f' in columns:
+        f_values = column('f')
+    else:
+        f_values = 10 ** column('log_gf') / column('g_lower')
+
+    rows = np.empty(len(table), dtype=CATALOG_DTYPE)
+    rows['species'] = [row[columns['species']].strip().strip("'") for row in table] if 'species' in columns else species
+    rows['wavelength'] = wavelength
+    rows['f'] = f_values
+    rows['gamma'] = column('gamma')
+    if 'line' in columns:
+        rows['line'] = column('line')
+    else:
+        # the shortest wavelength of the species
+        names, inverse = np.unique(rows['species'], return_inverse=True)
+        first = np.full(names.size, np.inf)
+        np.minimum.at(first, inverse, wavelength)
+        rows['line'] = first[inverse]
+    return rows
+
+
+class LineCatalog:
+    """
+    Columnar transition catalog indexed by species name and by wavelength.
+
+    The rows are sorted by (species, wavelength), so all transitions of a species are one
+    contiguous slice found by binary search in the sorted species names. A second index holds
+    the row order sorted by wavelength, so a wavelength range is one slice of it found by
+    binary search as well.
+
+    Parameters:
+    -----------
+    rows : numpy structured array
+        Transitions with dtype CATALOG_DTYPE, in any order
+    """
+
+    def __init__(self, rows):
+        rows = np.asarray(rows, dtype=CATALOG_DTYPE)
+        self.rows = rows[np.lexsort((rows['wavelength'], rows['species']))]
+        self.names, self.starts = np.unique(self.rows['species'], return_index=True)
+        self.stops = np.append(self.starts[1:], self.rows.size)
+        self.wave_order = np.argsort(self.rows['wavelength'], kind='stable')
+        self.wave_sorted = self.rows['wavelength'][self.wave_order]
+
+    def __len__(self):
+        return self.rows.size
+
+    def __contains__(self, name):
+        i = np.searchsorted(self.names, name)
+        return i < self.names.size and self.names[i] == name
+
+    def species(self, name):
+        """All transitions of species name, sorted by wavelength."""
+        i = np.searchsorted(self.names, name)
+        if i == self.names.size or self.names[i] != name:
+            raise KeyError(f"Species {name} is not in the line catalog")
+        return self.rows[self.starts[i]:self.stops[i]]
+
+    def in_range(self, wave_min, wave_max, f_min=0.0):
+        """All transitions with wave_min <= wavelength <= wave_max and f >= f_min, sorted by wavelength."""
+        start = np.searchsorted(self.wave_sorted, wave_min, side='left')
+        stop = np.searchsorted(self.wave_sorted, wave_max, side='right')
+        rows = self.rows[self.wave_order[start:stop]]
+        return rows[rows['f'] >= f_min]
+
+    def reference_line(self, name):
+        """The reference wavelength of species name (the 'line' column of species.txt)."""
+        return float(self.species(name)['line'][0])
+
+    def species_params(self, name):
+        """The 'lambda', 'f' and 'gamma' lists of species name, as used in species_params."""
+        rows = self.species(name)
+        return {
+            'lambda': rows['wavelength'].tolist(),
+            'f': rows['f'].tolist(),
+            'gamma': rows['gamma'].tolist(),
+        }
+
+    def save(self, path):
+        """Write the catalog and its indices to a binary .npz file."""
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, rows=self.rows, names=self.names, starts=self.starts, stops=self.stops,
+                 wave_order=self.wave_order, wave_sorted=self.wave_sorted)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a catalog written by save, without re-sorting."""
+        catalog = cls.__new__(cls)
+        with np.load(path) as data:
+            for key in ('rows', 'names', 'starts', 'stops', 'wave_order', 'wave_sorted'):
+                setattr(catalog, key, data[key])
+        return catalog
+
+
+_catalogs = {}
+
+
+def load_catalog(path='species.txt'):
+    """
+    The LineCatalog of path, which is either a binary catalog (.npz) or a species.txt style
+    table. A table is converted once to a binary catalog next to it (path + '.npz'), which is
+    used as long as it is newer than the table. Catalogs are kept in memory per path.
+    """
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    cached = _catalogs.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    if path.endswith('.npz'):
+        catalog = LineCatalog.load(path)
+    else:
+        binary = path + '.npz'
+        if os.path.exists(binary) and os.path.getmtime(binary) >= mtime:
+            catalog = LineCatalog.load(binary)
+        else:
+            catalog = LineCatalog(read_species_file(path))
+            try:
+                catalog.save(binary)
+            except OSError:
+                pass  # read-only directory, keep the catalog in memory only
+
+    _catalogs[path] = (mtime, catalog)
+    return catalog
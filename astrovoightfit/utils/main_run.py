@@ -1,55 +1,25 @@
-from edibles.utils.edibles_oracle import EdiblesOracle
-from edibles.utils.edibles_spectrum import EdiblesSpectrum
 from astrovoigtfit import *
+from line_catalog import load_catalog
+from observation_cache import observation_list, observation_window
 
 # calling standard python libraries
 import numpy as np
-import matplotlib.pyplot as plt
-import re
+
+
+def observation_file(star, molecule, file_no, species_file='species.txt'):
+
+    line_val = load_catalog(species_file).reference_line(molecule)
+
+    # Oracle queries are cached on disk, see observation_cache
+    return observation_list(star, line_val)[file_no]
 
 
 def observations(star,molecule,file_no, wave_range,species_file='species.txt'):
     
-    with open(species_file) as f:
-        lines = f.readlines()
-
-    headers = lines[0].split()
-    line_index = headers.index('line')
-
-    for line in lines[1:]:
-        parts = line.split()
-        if parts[0] == molecule:
-            line_val = parts[line_index].strip('[]')
-            line_val = float(line_val)
-            # print(line_val)
-            # print(wave_range)
-            
-    pythia = EdiblesOracle()
-    List = pythia.getFilteredObsList(object=[star], MergedOnly=False, Wave=line_val)
-
-    # print(List)
-    test = List.values.tolist()
-    # print(test)
-    
-    filename = test[file_no]
+    # extracted windows are cached on disk as well
+    filename = observation_file(star, molecule, file_no, species_file)
     print(filename)
-    wrange = wave_range
-    sp = EdiblesSpectrum(filename)
-    sp.getSpectrum(wrange[0],wrange[1])
-    wave = sp.bary_wave
-    flux = sp.bary_flux
-    idx = np.where((wave > wrange[0]) & (wave < wrange[1]))
-    wave = wave[idx]
-    flux = flux[idx]
-    flux = flux / np.median(flux)
-
-    # Filter the spectrum within the specified wavelength range
-    idx = np.where((wave > wrange[0]) & (wave < wrange[1]))
-    wave = wave[idx]
-    flux = flux[idx]
-
-    # Normalize the flux
-    flux = flux / np.median(flux)
+    wave, flux = observation_window(filename, wave_range)
     
     return wave, flux
     
@@ -91,58 +61,41 @@ def continuum_fit(star, molecule,file_no, wave_range, absorption_range):
     # plt.title('Normalized Spectrum')
 
 
-def _parse_bracketed_list(s):
-    inner = s.strip().strip('[]')
-    if not inner:
-        return []
-    return [float(x.strip()) for x in inner.split(',') if x.strip()]
-
 def get_species_params(species_file, species_params, molecule):
-    with open(species_file) as f:
-        lines = f.readlines()
+    catalog = load_catalog(species_file)
 
     for idx, species in enumerate(molecule):
-        for line in lines[1:]:
-            if not line.strip():
-                continue
-            # species name is first whitespace-separated token
-            parts = line.split()
-            if parts[0] != species:
-                continue
-
-            # extract the three bracketed columns (lambda, f_value, gamma)
-            bracketed = re.findall(r'\[.*?\]', line)
-            if len(bracketed) < 3:
-                raise ValueError(f"Line for species {species} does not have expected bracketed fields: {line!r}")
-
-            lambda_vals = _parse_bracketed_list(bracketed[0])
-            f_vals = _parse_bracketed_list(bracketed[1])
-            gamma_vals = _parse_bracketed_list(bracketed[2])
+        if species not in catalog:
+            continue
 
-            print(f"Species: {species}, Lambda: {lambda_vals}, f: {f_vals}, Gamma: {gamma_vals}")
+        reordered = catalog.species_params(species)
+        print(f"Species: {species}, Lambda: {reordered['lambda']}, f: {reordered['f']}, Gamma: {reordered['gamma']}")
 
-            reordered = {
-                'lambda': lambda_vals,
-                'f': f_vals,
-                'gamma': gamma_vals,
-            }
+        for key, value in species_params[idx].items():
+            reordered[key] = value
 
-            for key, value in species_params[idx].items():
-                reordered[key] = value
-
-            species_params[idx] = reordered
-            break  # found species line, move to next
+        species_params[idx] = reordered
 
     return species_params
 
 
 
 
-def astrovoigtfit_run(star,molecule, wave_range,species_params,absorption_range,file_no,species_file='species.txt'):
+def astrovoigtfit_run(star,molecule, wave_range,species_params,absorption_range,file_no,species_file='species.txt',
+                      use_store=False):
+    """
+    Fit one observation and plot the result, starting from the species_params guesses. With
+    use_store the fit instead starts from the last converged fit of the same star, species and
+    window, if any, and is added to the fit store (see fit_store; ASTROVOIGTFIT_STORE sets its
+    path). By default the store is neither read nor written.
+    """
+    import matplotlib.pyplot as plt
     
     # Get the observed spectrum and fit the continuum
     
-    wave, flux = observations(star,molecule[0],file_no, wave_range,species_file)
+    filename = observation_file(star, molecule[0], file_no, species_file)
+    print(filename)
+    wave, flux = observation_window(filename, wave_range)
     species_param_updated = get_species_params(species_file, species_params, molecule)
     # print("Species parameters:", species_param_updated)
     
@@ -162,8 +115,13 @@ def astrovoigtfit_run(star,molecule, wave_range,species_params,absorption_range,
         species_params=species_param_updated,
         v_resolution=3, 
         n_step=25, 
-        std_dev=0.0014
+        std_dev=0.0014,
+        # start from the last converged fit of this star, species and window (see fit_store)
+        store_key=(star, filename, tuple(molecule), wave_range)
+        if use_store else None
     )
+    if use_store and fitresult.warm_start is not None:
+        print(f"Initial guesses taken from an earlier fit ({fitresult.warm_start} match)")
     fitresult.params.pretty_print() #printing the fitting parameters
 
 
@@ -0,0 +1,150 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from astrovoigtfit import astro_voigt_fit
+from batch_run import _init_worker
+
+
+# bounds of b in astro_voigt_fit
+B_BOUNDS = (0.5, 5.5)
+
+
+def latin_hypercube(n_samples, n_dim, rng):
+    """n_samples points in [0, 1)^n_dim with exactly one point in every 1/n_samples slice of every axis."""
+    u = (np.arange(n_samples)[:, None] + rng.random((n_samples, n_dim))) / n_samples
+    for k in range(n_dim):
+        u[:, k] = rng.permutation(u[:, k])
+    return u
+
+
+def starting_points(species_params, n_starts, n_decades=1.0, v_jitter=5.0, seed=None):
+    """
+    n_starts copies of species_params with new b, N and v_rad guesses. The first one is
+    species_params itself; the others are drawn on a Latin hypercube: b uniform within
+    B_BOUNDS, N log-uniform within n_decades of the guess, and v_rad uniform within
+    +/- v_jitter km/s of the guess. Components whose v_rad guesses are tied in
+    astro_voigt_fit (same component index and value) get the same jitter.
+    """
+    rng = np.random.default_rng(seed)
+    components = [(s, i) for s in species_params for i in range(np.size(species_params[s]['v_rad']))]
+    v_groups = sorted({(i, float(np.atleast_1d(species_params[s]['v_rad'])[i])) for s, i in components})
+    n_comp = len(components)
+    u = latin_hypercube(n_starts - 1, 2 * n_comp + len(v_groups), rng)
+
+    starts = [copy.deepcopy(species_params)]
+    for row in u:
+        start = copy.deepcopy(species_params)
+        for s in start:
+            for key in ('b', 'N', 'v_rad'):
+                start[s][key] = np.array(start[s][key], dtype=float)
+        for k, (s, i) in enumerate(components):
+            N = float(np.atleast_1d(species_params[s]['N'])[i])
+            v_rad = float(np.atleast_1d(species_params[s]['v_rad'])[i])
+            start[s]['b'][i] = B_BOUNDS[0] + row[k] * (B_BOUNDS[1] - B_BOUNDS[0])
+            start[s]['N'][i] = N * 10 ** (n_decades * (2 * row[n_comp + k] - 1))
+            start[s]['v_rad'][i] = v_rad + v_jitter * (2 * row[2 * n_comp + v_groups.index((i, v_rad))] - 1)
+        starts.append(start)
+    return starts
+
+
+def _component_names(species_params):
+    # names of the b, N and v_rad parameters of every component, as in astro_voigt_fit
+    return [f'{key}_{s}_{i}' for s in species_params for i in range(np.size(species_params[s]['v_rad']))
+            for key in ('b', 'N', 'v_rad')]
+
+
+def _fit_start(args):
+    # one local fit; only a summary is sent back to the parent process
+    index, wavegrid, ydata, species_params, fit_kwargs = args
+    try:
+        result = astro_voigt_fit(wavegrid, ydata, species_params, **fit_kwargs)
+    except Exception as e:
+        return {'start': index, 'chisqr': np.inf, 'success': False, 'error': f'{type(e).__name__}: {e}'}
+    values = {name: result.params[name].value for name in _component_names(species_params)}
+    return {'start': index, 'chisqr': float(result.chisqr), 'success': bool(result.success),
+            'nfev': result.nfev, 'values': values}
+
+
+def astro_voigt_multistart(wavegrid, ydata, species_params, n_starts=16, n_workers=None, n_agree=3,
+                           chi2_rtol=1e-3, n_decades=1.0, v_jitter=5.0, seed=None, **fit_kwargs):
+    """
+    Run astro_voigt_fit from many starting points in a process pool and keep the best fit.
+
+    The starting points are drawn by starting_points. The local fits run in parallel; as soon
+    as n_agree of them reach the lowest chi-square found so far (within a relative chi2_rtol),
+    the fits that have not started yet are cancelled. Fits already running cannot be
+    interrupted; they finish in the background and their results are discarded, so the best
+    start is fitted once more in this process (to return a full ModelResult) without waiting
+    for them.
+
+    Parameters:
+    -----------
+    wavegrid, ydata, species_params :
+        As for astro_voigt_fit; species_params holds the user's guess, used as the first start
+    n_starts : int
+        Maximum number of starting points
+    n_workers : int
+        Number of worker processes (default: number of CPUs); 1 runs the fits in this process
+    n_agree : int
+        Number of starts that must agree on the best chi-square before stopping early
+    chi2_rtol : float
+        Relative chi-square tolerance for two fits to agree
+    n_decades, v_jitter : float
+        Range of the N and v_rad starting points, see starting_points
+    seed : int
+        Seed of the starting points
+    **fit_kwargs :
+        Passed on to astro_voigt_fit (v_resolution, std_dev, backend, jacobian, ...)
+
+    Returns:
+    --------
+    result : lmfit.model.ModelResult
+        Best fit, with result.starts holding the summary (start index, chisqr, success and
+        fitted values) of every start that was run, sorted by chisqr, and result.spread the
+        standard deviation of every b, N and v_rad over the starts that agree with the best
+    """
+    starts = starting_points(species_params, n_starts, n_decades, v_jitter, seed)
+    tasks = [(k, wavegrid, ydata, start, fit_kwargs) for k, start in enumerate(starts)]
+    summaries = []
+
+    def converged():
+        chisqr = sorted(summary['chisqr'] for summary in summaries)
+        return len(chisqr) >= n_agree and chisqr[n_agree - 1] <= chisqr[0] * (1 + chi2_rtol)
+
+    if n_workers == 1:
+        for task in tasks:
+            summaries.append(_fit_start(task))
+            if converged():
+                break
+    else:
+        pool = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker)
+        try:
+            futures = [pool.submit(_fit_start, task) for task in tasks]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                if converged():
+                    break
+        finally:
+            # cancel the fits that have not started and do not wait for the running ones
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    summaries.sort(key=lambda summary: summary['chisqr'])
+    best = summaries[0]
+    if 'error' in best:
+        raise RuntimeError(f"All {len(summaries)} starts failed, first error: {best['error']}")
+
+    # refit from the best solution to get the full result in this process
+    best_params = copy.deepcopy(species_params)
+    for s in best_params:
+        for key in ('b', 'N', 'v_rad'):
+            best_params[s][key] = [best['values'][f'{key}_{s}_{i}']
+                                   for i in range(np.size(species_params[s]['v_rad']))]
+    result = astro_voigt_fit(wavegrid, ydata, best_params, **fit_kwargs)
+
+    agreeing = [summary for summary in summaries if summary['chisqr'] <= best['chisqr'] * (1 + chi2_rtol)]
+    result.starts = summaries
+    result.spread = {name: float(np.std([summary['values'][name] for summary in agreeing]))
+                     for name in best['values']}
+    return result
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+# Directory of the cached observation lists and spectrum windows
+CACHE_DIR = os.environ.get(
+    "ASTROVOIGTFIT_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "astrovoigtfit", "observations"),
+)
+
+_obs_lists = None
+# guards _obs_lists, which the threads of fit_server share
+_obs_lists_lock = threading.Lock()
+
+
+def _replace_atomically(path, write):
+    # write to a temporary file first, so that concurrent runs never read a partial file; the
+    # name is unique per call, as threads of one process may write the same path at once
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix=".tmp" + os.path.splitext(path)[1], dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _obs_list_path():
+    return os.path.join(CACHE_DIR, "obs_lists.json")
+
+
+def _window_path(filename, wave_range):
+    key = f"{filename}|{float(wave_range[0])!r}|{float(wave_range[1])!r}"
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+
+def observation_list(star, wave):
+    """
+    Filenames of the EDIBLES observations of star covering wave, as returned by
+    EdiblesOracle.getFilteredObsList(object=[star], MergedOnly=False, Wave=wave).
+
+    The lists are memoised in memory and in CACHE_DIR, so the Oracle (and its CSV parsing)
+    is only used the first time a (star, wave) pair is queried.
+    """
+    global _obs_lists
+    key = f"{star}|{float(wave)!r}"
+    with _obs_lists_lock:
+        if _obs_lists is None:
+            _obs_lists = {}
+            if os.path.exists(_obs_list_path()):
+                with open(_obs_list_path()) as f:
+                    _obs_lists = json.load(f)
+        if key in _obs_lists:
+            return _obs_lists[key]
+
+    from edibles.utils.edibles_oracle import EdiblesOracle
+
+    pythia = EdiblesOracle()
+    List = pythia.getFilteredObsList(object=[star], MergedOnly=False, Wave=wave)
+    filenames = [str(filename) for filename in np.ravel(List.values.tolist())]
+
+    def write(tmp):
+        with open(tmp, "w") as f:
+            json.dump(_obs_lists, f, indent=1)
+    with _obs_lists_lock:
+        _obs_lists[key] = filenames
+        _replace_atomically(_obs_list_path(), write)
+
+    return filenames
+
+
+def load_window(filename, wave_range):
+    """The cached (wave, flux) window of filename, memory-mapped, or None if it is not cached."""
+    path = _window_path(filename, wave_range)
+    if not os.path.exists(path):
+        return None
+    window = np.load(path, mmap_mode="r")
+    return np.asarray(window[0]), np.asarray(window[1])
+
+
+def save_window(filename, wave_range, wave, flux):
+    """Store the (wave, flux) window of filename in the cache."""
+    window = np.stack([np.asarray(wave, dtype=float), np.asarray(flux, dtype=float)])
+    _replace_atomically(_window_path(filename, wave_range), lambda tmp: np.save(tmp, window))
+
+
+def observation_window(filename, wave_range):
+    """
+    Barycentric wavelength and median normalised flux of the EDIBLES spectrum filename within
+    wave_range (exclusive).
+
+    The window is extracted from the FITS file once and then read from CACHE_DIR as a
+    memory-mapped .npy file.
+    """
+    window = load_window(filename, wave_range)
+    if window is not None:
+        return window
+
+    from edibles.utils.edibles_spectrum import EdiblesSpectrum
+
+    sp = EdiblesSpectrum(filename)
+    sp.getSpectrum(wave_range[0], wave_range[1])
+    wave = sp.bary_wave
+    flux = sp.bary_flux
+    idx = np.where((wave > wave_range[0]) & (wave < wave_range[1]))
+    wave = wave[idx]
+    flux = flux[idx]
+    flux = flux / np.median(flux)
+
+    save_window(filename, wave_range, wave, flux)
+    return load_window(filename, wave_range)
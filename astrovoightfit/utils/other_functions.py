@@ -1,8 +1,22 @@
+from collections import OrderedDict
+
 import numpy as np
-import astropy.constants as cst
 from scipy.special import wofz
-from scipy.interpolate import interp1d
 from scipy.ndimage import gaussian_filter
+from faddeeva import faddeeva
+
+
+# Constants in the units used throughout (CODATA 2022, the values of astropy.constants, which
+# is not imported to keep the import of the model light)
+C_KMS = 299792.458
+C_ANGSTROM = C_KMS * 1e13
+# pi e^2 / (m_e c) in cgs units, i.e. tau_factor = TAU_CONSTANT * N * f
+_E_ESU = 4.803204712570263e-10
+_M_E_G = 9.1093837139e-28
+TAU_CONSTANT = np.pi * _E_ESU ** 2 / _M_E_G / (C_KMS * 1e5)
+# Approximate peak memory (bytes) of voigt_optical_depth_grid per (line, pixel) window pair,
+# used to turn its max_memory budget into a number of pairs per chunk
+PAIR_BYTES = 256
 
 
 def fwhm2sigma(fwhm):
@@ -54,13 +68,15 @@ def getVGrid(lambda0, gamma, b, v_resolution, n_step):
     return dv
 
 
-def voigt_profile(x, sigma, gamma):
+def voigt_profile(x, sigma, gamma, backend="scipy"):
     """
     Function to return the value of a (normalized) Voigt profile centered at x=0
     and with (Gaussian) width sigma and Lorentz damping (=HWHM) gamma.
 
-    The Voigt profile is computed using the scipy.special.wofz, which returns
-    the value of the Faddeeva function.
+    The Voigt profile is computed from the real part of the Faddeeva function.
+    By default this is scipy.special.wofz; the numba compiled "humlicek" and
+    "weideman" backends are faster, see faddeeva.BACKEND_MAX_REL_ERROR for their
+    accuracy.
 
 
     WARNING
@@ -70,18 +86,23 @@ def voigt_profile(x, sigma, gamma):
         x (float64): Scalar or array of x-values
         sigma (float64): Gaussian sigma component
         gamma (float64): Lorentzian gamma (=HWHM) component
+        backend (str): Faddeeva backend, "scipy", "humlicek" or "weideman"
 
     Returns:
         ndarray: Flux array for given input
 
     """
 
-    z = (x + 1j * gamma) / sigma / np.sqrt(2)
+    if backend == "scipy":
+        z = (x + 1j * gamma) / sigma / np.sqrt(2)
+        return np.real(wofz(z)) / sigma / np.sqrt(2 * np.pi)
 
-    return np.real(wofz(z)) / sigma / np.sqrt(2 * np.pi)
+    K, _ = faddeeva(x / sigma / np.sqrt(2), gamma / sigma / np.sqrt(2), backend=backend)
 
+    return K / sigma / np.sqrt(2 * np.pi)
 
-def voigt_optical_depth(wave, lambda0=0.0, b=0.0, N=0.0, f=0.0, gamma=0.0, v_rad=0.0):
+
+def voigt_optical_depth(wave, lambda0=0.0, b=0.0, N=0.0, f=0.0, gamma=0.0, v_rad=0.0, backend="scipy"):
     """
     Function to return the value of a Voigt optical depth profile at a given wavelength, for a line
     centered at lambda0.
@@ -94,6 +115,7 @@ def voigt_optical_depth(wave, lambda0=0.0, b=0.0, N=0.0, f=0.0, gamma=0.0, v_rad
         f (float64): The oscillator strength (dimensionless)
         gamma (float64): Lorentzian gamma (=HWHM) component
         v_rad (float64): Radial velocity of absorption line (in km/s)
+        backend (str): Faddeeva backend used by voigt_profile
 
     Returns:
         float64: Optical Depth at wave.
@@ -102,11 +124,11 @@ def voigt_optical_depth(wave, lambda0=0.0, b=0.0, N=0.0, f=0.0, gamma=0.0, v_rad
 
     # All we have to do is proper conversions so that we feed the right numbers into the call
     # to the VoigtProfile -- see documentation for details.
-    nu = cst.c.to("angstrom/s").value / wave
-    nu0 = cst.c.to("angstrom/s").value / lambda0
+    nu = C_ANGSTROM / wave
+    nu0 = C_ANGSTROM / lambda0
     sigma = (b * 1e13) / lambda0 / np.sqrt(2)
     gamma_voigt = gamma / 4 / np.pi
-    tau_factor = (N * np.pi * cst.e.esu ** 2 / cst.m_e.cgs / cst.c.cgs * f).value
+    tau_factor = TAU_CONSTANT * N * f
 
     # print("Nu0 is:        " + "{:e}".format(nu0))
     # print("Sigma is:      " + "{:e}".format(sigma))
@@ -115,7 +137,335 @@ def voigt_optical_depth(wave, lambda0=0.0, b=0.0, N=0.0, f=0.0, gamma=0.0, v_rad
 
     # Transform this into a frequency grid centered around nu0
 
-    ThisVoigtProfile = voigt_profile(nu - nu0, sigma, gamma_voigt)
+    ThisVoigtProfile = voigt_profile(nu - nu0, sigma, gamma_voigt, backend=backend)
     tau = tau_factor * ThisVoigtProfile
 
-    return tau
\ No newline at end of file
+    return tau
+
+
+def voigt_optical_depth_grid(refgrid, lambda0, f, gamma, b, N, v_rad, v_resolution=0.0, backend="scipy",
+                             line_batch=None, n_batch=1, max_memory=None):
+    """
+    Function to return the summed optical depth of many lines evaluated directly on a shared
+    (sorted) reference wavelength grid.
+
+    Every line is only evaluated inside its own window of +/- 8.5 * max(Voigt FWHM, v_resolution)
+    around its (Doppler shifted) centre -- the same window getVGrid uses. The pixels of all
+    windows are flattened into one array so that voigt_optical_depth is called once for all
+    lines, and the contributions are summed back onto refgrid with np.bincount.
+
+    Compared to evaluating each line on its own velocity grid and resampling it with a cubic
+    interp1d (the previous mother_function loop), the profile is evaluated exactly at every
+    refgrid pixel. Measured on the normalised model of mother_function (default n_step):
+    for optically thin lines (central optical depth below ~0.2, b >= v_resolution / 3, with
+    v_resolution 1 - 6 km/s) it differs from the interpolated one by less than 1e-4 (absolute).
+    For saturated lines (central optical depth 2 - 35) the difference reaches ~5e-4, and for
+    lines much narrower than the resolution (b = 0.6 km/s, v_resolution = 6 km/s) 1e-2 and
+    more. The interpolated model is the less accurate one: against the convolution of the
+    optical depth on a very fine grid the new model is within 7e-4 in all these cases (1.2e-4
+    for the narrow lines), the interpolated one up to 0.35 off for the narrow lines.
+
+    With max_memory, the window pixels are processed in chunks of at most
+    max_memory / PAIR_BYTES (line, pixel) pairs (see line_window_chunks) and added to the optical
+    depth in place with np.add.at, so the peak memory no longer grows with the number of lines. The result is
+    identical to the unchunked one, as every pixel sums its contributions in the same order.
+
+    Args:
+        refgrid (float64): Sorted wavelength grid (in Angstrom) to evaluate the optical depth on.
+        lambda0 (float64): Array of central (rest) wavelengths, in Angstrom.
+        f (float64): Array of oscillator strengths.
+        gamma (float64): Array of Lorentzian gamma (=HWHM) components.
+        b (float64): Array of b parameters, in km/s.
+        N (float64): Array of column densities, in cm^{-2}.
+        v_rad (float64): Array of radial velocities, in km/s.
+        v_resolution (float64): Instrumental resolution (FWHM), in km/s.
+        backend (str): Faddeeva backend used by voigt_profile.
+        line_batch (int): Optional array with the index (0 .. n_batch - 1) of the parameter set
+            every line belongs to; the lines of every set are then summed separately.
+        n_batch (int): Number of parameter sets.
+        max_memory (int): Optional memory budget (bytes) of the window pixels; None evaluates
+            all lines at once.
+
+    Returns:
+        ndarray: Total optical depth at every refgrid pixel, shape (n_batch, len(refgrid)) if
+        line_batch is given.
+
+    """
+
+    refgrid = np.asarray(refgrid)
+    lambda0, f, gamma, b, N, v_rad = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float)) for x in (lambda0, f, gamma, b, N, v_rad)))
+    max_pairs = None if max_memory is None else max(1, int(max_memory // PAIR_BYTES))
+    tau = np.zeros(n_batch * refgrid.size)
+
+    for line_idx, pix_idx in line_window_chunks(refgrid, lambda0, gamma, b, v_rad, v_resolution, max_pairs):
+        # Velocity relative to the shifted line centre, mapped back to the rest frame of the line
+        lam = lambda0[line_idx]
+        dv = (refgrid[pix_idx] / lam - 1.0) * C_KMS - v_rad[line_idx]
+        tau_pairs = voigt_optical_depth(
+            lam * (1.0 + dv / C_KMS),
+            lambda0=lam,
+            b=b[line_idx],
+            N=N[line_idx],
+            f=f[line_idx],
+            gamma=gamma[line_idx],
+            backend=backend,
+        )
+
+        if line_batch is not None:
+            pix_idx = np.asarray(line_batch)[line_idx] * refgrid.size + pix_idx
+        if max_pairs is None:
+            # the one chunk holds all pairs
+            tau = np.bincount(pix_idx, weights=tau_pairs, minlength=tau.size)
+        else:
+            # unbuffered, in order: the same sums as np.bincount over all pairs at once
+            np.add.at(tau, pix_idx, tau_pairs)
+
+    if line_batch is not None:
+        return tau.reshape(n_batch, refgrid.size)
+
+    return tau
+
+
+class TauCache:
+    """
+    Least recently used cache of the optical depth of single lines at unit column density.
+
+    tau is proportional to N, so the profile of a line only depends on its shape parameters
+    (lambda0, f, gamma, b, v_rad) and the reference grid. Finite difference steps change one
+    parameter at a time, so during a fit most lines keep their shape from one evaluation to
+    the next: their cached window is rescaled by N instead of evaluated again, so a step in N
+    needs no Voigt profile evaluation at all. hits and misses count the lines; maxsize is the
+    number of lines kept.
+
+    A window is stored with the wavelength of its first pixel, so it can be reused on any
+    reference grid made of the same lattice points (see model.lattice_segments), as long as
+    the caller identifies that lattice with grid_key.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._profiles = OrderedDict()
+
+    def optical_depth(self, refgrid, lambda0, f, gamma, b, N, v_rad, v_resolution=0.0, backend="scipy",
+                      grid_key=None):
+        """
+        Summed optical depth on refgrid, as voigt_optical_depth_grid (equal to rounding).
+        grid_key is a tuple identifying the lattice refgrid is cut from; by default refgrid
+        itself (its size and end points).
+        """
+        if grid_key is None:
+            grid_key = (refgrid.size, refgrid[0], refgrid[-1])
+        grid_key = tuple(grid_key) + (v_resolution, backend)
+        keys = [grid_key + line for line in zip(lambda0.tolist(), f.tolist(), gamma.tolist(),
+                                                 b.tolist(), v_rad.tolist())]
+        entries = [self._profiles.get(key) for key in keys]
+        missing = np.array([k for k, entry in enumerate(entries) if entry is None], dtype=int)
+        self.hits += len(keys) - missing.size
+        self.misses += missing.size
+
+        if missing.size:
+            # unit column density profiles of the new lines, with one Faddeeva call
+            line_idx, pix_idx = line_windows(refgrid, lambda0[missing], gamma[missing], b[missing],
+                                             v_rad[missing], v_resolution)
+            lam = lambda0[missing][line_idx]
+            dv = (refgrid[pix_idx] / lam - 1.0) * C_KMS - v_rad[missing][line_idx]
+            tau_unit = voigt_optical_depth(lam * (1.0 + dv / C_KMS), lambda0=lam, b=b[missing][line_idx],
+                                           N=1.0, f=f[missing][line_idx], gamma=gamma[missing][line_idx],
+                                           backend=backend)
+            ends = np.cumsum(np.bincount(line_idx, minlength=missing.size))
+            for j, k in enumerate(missing):
+                first = ends[j - 1] if j else 0
+                entries[k] = (refgrid[pix_idx[first]] if ends[j] > first else refgrid[0], tau_unit[first:ends[j]])
+                self._profiles[keys[k]] = entries[k]
+        for key in keys:
+            self._profiles.move_to_end(key)
+        while len(self._profiles) > self.maxsize:
+            self._profiles.popitem(last=False)
+
+        # sum the windows scaled by N, in line order as voigt_optical_depth_grid
+        # (the slack absorbs a last-bit difference of the lattice points between grids)
+        start = np.searchsorted(refgrid, np.array([entry[0] for entry in entries]) * (1.0 - 1e-12))
+        counts = np.array([entry[1].size for entry in entries])
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pix_idx = np.repeat(start, counts) + offsets
+        tau_pairs = np.repeat(N, counts) * np.concatenate([entry[1] for entry in entries])
+        return np.bincount(pix_idx, weights=tau_pairs, minlength=refgrid.size)
+
+
+def line_windows(refgrid, lambda0, gamma, b, v_rad, v_resolution=0.0):
+    """
+    Function to return the (line, pixel) index pairs of all refgrid pixels that fall inside the
+    window of +/- 8.5 * max(Voigt FWHM, v_resolution) around each (Doppler shifted) line.
+
+    Args:
+        refgrid (float64): Sorted wavelength grid, in Angstrom.
+        lambda0 (float64): Array of central (rest) wavelengths, in Angstrom.
+        gamma (float64): Array of Lorentzian gamma (=HWHM) components.
+        b (float64): Array of b parameters, in km/s.
+        v_rad (float64): Array of radial velocities, in km/s.
+        v_resolution (float64): Instrumental resolution (FWHM), in km/s.
+
+    Returns:
+        tuple: (line_idx, pix_idx) integer arrays, grouped per line.
+
+    """
+
+    start, counts = _window_bounds(refgrid, lambda0, gamma, b, v_rad, v_resolution)
+
+    line_idx = np.repeat(np.arange(lambda0.size), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pix_idx = np.repeat(start, counts) + offsets
+
+    return line_idx, pix_idx
+
+
+def line_window_chunks(refgrid, lambda0, gamma, b, v_rad, v_resolution=0.0, max_pairs=None):
+    """
+    Function to generate the (line, pixel) index pairs of line_windows in consecutive chunks of
+    at most max_pairs pairs (a window may be split over two chunks), without building the full
+    arrays. With max_pairs None, the one chunk is line_windows itself.
+
+    Args:
+        refgrid, lambda0, gamma, b, v_rad, v_resolution: As for line_windows.
+        max_pairs (int): Maximum number of pairs per chunk.
+
+    Yields:
+        tuple: (line_idx, pix_idx) integer arrays; concatenated, they equal line_windows.
+
+    """
+
+    if max_pairs is None:
+        yield line_windows(refgrid, lambda0, gamma, b, v_rad, v_resolution)
+        return
+
+    start, counts = _window_bounds(refgrid, lambda0, gamma, b, v_rad, v_resolution)
+    ends = np.cumsum(counts)
+
+    for p0 in range(0, int(ends[-1]) if ends.size else 0, max_pairs):
+        p1 = min(p0 + max_pairs, int(ends[-1]))
+        # the lines with pairs in [p0, p1), and the part of their window inside the chunk
+        lines = np.arange(np.searchsorted(ends, p0, side="right"), np.searchsorted(ends, p1 - 1, side="right") + 1)
+        first = ends[lines] - counts[lines]
+        seg_start = np.maximum(p0 - first, 0)
+        n = np.minimum(p1 - first, counts[lines]) - seg_start
+
+        line_idx = np.repeat(lines, n)
+        offsets = np.arange(p1 - p0) - np.repeat(np.cumsum(n) - n, n)
+        pix_idx = np.repeat(start[lines] + seg_start, n) + offsets
+        yield line_idx, pix_idx
+
+
+def _window_bounds(refgrid, lambda0, gamma, b, v_rad, v_resolution):
+    # first refgrid pixel and number of pixels of the window of every line
+    half_width = 8.5 * np.maximum(VoigtFWHM(lambda0, gamma, b), v_resolution)
+    start = np.searchsorted(refgrid, lambda0 * (1.0 + (v_rad - half_width) / C_KMS), side="left")
+    stop = np.searchsorted(refgrid, lambda0 * (1.0 + (v_rad + half_width) / C_KMS), side="right")
+    return start, stop - start
+
+
+def line_peak_tau(lambda0, f, gamma, b, N):
+    """
+    Function to return an upper bound on the peak optical depth of every line: the Voigt peak
+    is below both the Gaussian peak 1 / (sigma sqrt(2 pi)) and the Lorentzian peak 1 / (pi gamma).
+
+    Args:
+        lambda0, f, gamma, b, N (float64): Line arrays, as for voigt_optical_depth_grid.
+
+    Returns:
+        float64: Array of peak optical depths (upper bounds).
+
+    """
+
+    sigma = (b * 1e13) / lambda0 / np.sqrt(2)
+    gamma_voigt = gamma / 4 / np.pi
+    peak = 1.0 / (sigma * np.sqrt(2 * np.pi))
+    peak = np.minimum(peak, np.divide(1.0, np.pi * gamma_voigt, out=np.full(peak.shape, np.inf),
+                                      where=gamma_voigt > 0))
+    return TAU_CONSTANT * N * f * peak
+
+
+def cull_lines(wavegrid, lambda0, f, gamma, b, N, v_rad, v_resolution=0.0, flux_tol=0.0):
+    """
+    Function to find the lines that do not need to be evaluated on wavegrid: lines whose window
+    of +/- 8.5 * max(Voigt FWHM, v_resolution) (as in line_windows) lies entirely outside
+    wavegrid, and lines whose peak depth 1 - exp(-tau_peak) is below flux_tol.
+
+    flux_tol applies to every line on its own, so it should be set well below the noise when
+    many weak lines overlap.
+
+    Args:
+        wavegrid (float64): Observed wavelength grid, in Angstrom.
+        lambda0, f, gamma, b, N, v_rad (float64): Line arrays, as for voigt_optical_depth_grid.
+        v_resolution (float64): Instrumental resolution (FWHM), in km/s.
+        flux_tol (float64): Peak depth (in normalised flux) below which a line is dropped.
+
+    Returns:
+        tuple: (outside, weak) boolean arrays, one entry per line.
+
+    """
+
+    lambda0, f, gamma, b, N, v_rad = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float)) for x in (lambda0, f, gamma, b, N, v_rad)))
+
+    half_width = 8.5 * np.maximum(VoigtFWHM(lambda0, gamma, b), v_resolution)
+    outside = ((lambda0 * (1.0 + (v_rad + half_width) / C_KMS) < np.min(wavegrid))
+               | (lambda0 * (1.0 + (v_rad - half_width) / C_KMS) > np.max(wavegrid)))
+    weak = -np.expm1(-line_peak_tau(lambda0, f, gamma, b, N)) < flux_tol
+
+    return outside, weak
+
+
+def voigt_optical_depth_derivatives(refgrid, lambda0, f, gamma, b, N, v_rad, v_resolution=0.0,
+                                    backend="scipy"):
+    """
+    Function to return the optical depth of every line inside its window on refgrid, together
+    with its analytic derivatives with respect to b, N and v_rad.
+
+    tau is linear in N. The b and v_rad derivatives follow from the derivative of the
+    Faddeeva function, dw/dz = -2 z w + 2i / sqrt(pi), with z = (nu - nu0 + i gamma) / (sigma sqrt(2))
+    and sigma proportional to b.
+
+    Args:
+        refgrid (float64): Sorted wavelength grid, in Angstrom.
+        lambda0, f, gamma, b, N, v_rad (float64): Line arrays, as for voigt_optical_depth_grid.
+        v_resolution (float64): Instrumental resolution (FWHM), in km/s.
+        backend (str): Faddeeva backend, "scipy", "humlicek" or "weideman".
+
+    Returns:
+        tuple: (line_idx, pix_idx, tau, dtau_db, dtau_dN, dtau_dv_rad), one entry per
+        (line, pixel) pair as returned by line_windows.
+
+    """
+
+    refgrid = np.asarray(refgrid)
+    lambda0, f, gamma, b, N, v_rad = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float)) for x in (lambda0, f, gamma, b, N, v_rad)))
+    line_idx, pix_idx = line_windows(refgrid, lambda0, gamma, b, v_rad, v_resolution)
+
+    # Same frequency offsets as voigt_optical_depth_grid
+    lam = lambda0[line_idx]
+    b_l = b[line_idx]
+    dv = (refgrid[pix_idx] / lam - 1.0) * C_KMS - v_rad[line_idx]
+    wave = lam * (1.0 + dv / C_KMS)
+    sigma = (b_l * 1e13) / lam / np.sqrt(2)
+    x = (C_ANGSTROM / wave - C_ANGSTROM / lam) / sigma / np.sqrt(2)
+    y = gamma[line_idx] / 4 / np.pi / sigma / np.sqrt(2)
+    re, im = faddeeva(x, y, backend=backend)
+
+    # optical depth per unit column density
+    tau_unit = TAU_CONSTANT * f[line_idx] * re / sigma / np.sqrt(2 * np.pi)
+    tau = N[line_idx] * tau_unit
+
+    # real and imaginary part of dw/dz
+    dre = -2.0 * (x * re - y * im)
+    dim = -2.0 * (x * im + y * re) + 2.0 / np.sqrt(np.pi)
+
+    scale = N[line_idx] * TAU_CONSTANT * f[line_idx] / sigma / np.sqrt(2 * np.pi)
+    dtau_db = scale * (-(x * dre - y * dim) - re) / b_l
+    dx_dv_rad = C_ANGSTROM * lam / (C_KMS * wave ** 2) / sigma / np.sqrt(2)
+    dtau_dv_rad = scale * dre * dx_dv_rad
+
+    return line_idx, pix_idx, tau, dtau_db, tau_unit, dtau_dv_rad
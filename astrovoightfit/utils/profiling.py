@@ -0,0 +1,98 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+# FitProfile collecting the timings, or None when profiling is disabled. The model code only
+# calls stage() and count(), which return immediately in that case.
+_active = None
+_disabled = nullcontext()
+
+
+class FitProfile:
+    """
+    Wall time and number of calls per model stage, number of model and Jacobian evaluations,
+    and the sizes n_v of the reference grids used.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.n_v = []
+        self.total = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def record(self):
+        """JSON serialisable summary; 'other' is the time spent outside the model (lmfit)."""
+        n_v = self.n_v or [0]
+        # 'wrapper' (Voigt_fit_wrapper) includes 'evaluate' and the parameter unpacking
+        model_time = self.seconds.get('wrapper', self.seconds.get('evaluate', 0.0))
+        model_time += self.seconds.get('jacobian', 0.0)
+        return {
+            'total': self.total,
+            'other': max(self.total - model_time, 0.0),
+            'seconds': dict(self.seconds),
+            'calls': dict(self.calls),
+            'n_evaluations': self.calls.get('evaluate', 0),
+            'n_jacobians': self.calls.get('jacobian', 0),
+            'n_v': {'min': min(n_v), 'max': max(n_v), 'mean': sum(n_v) / len(n_v)},
+        }
+
+
+def stage(name):
+    """Context manager timing the stage name of the active profile (a no-op when disabled)."""
+    if _active is None:
+        return _disabled
+    return _active.stage(name)
+
+
+def record_grid(n_v):
+    """Note the size of a reference grid in the active profile."""
+    if _active is not None:
+        _active.n_v.append(int(n_v))
+
+
+@contextmanager
+def profile():
+    """
+    Collect a FitProfile of all model evaluations inside the with block.
+
+    Example:
+        with profile() as p:
+            master_function(wavegrid, **kwargs)
+        print(p.record())
+    """
+    global _active
+    previous = _active
+    _active = FitProfile()
+    start = time.perf_counter()
+    try:
+        yield _active
+    finally:
+        _active.total = time.perf_counter() - start
+        _active, previous = previous, _active
+
+
+def aggregate(records):
+    """Sum the profile records of many fits (e.g. the 'profile' entries of fit_many results)."""
+    total = {'total': 0.0, 'other': 0.0, 'seconds': defaultdict(float), 'calls': defaultdict(int),
+             'n_evaluations': 0, 'n_jacobians': 0, 'n_fits': 0}
+    for record in records:
+        total['n_fits'] += 1
+        for key in ('total', 'other', 'n_evaluations', 'n_jacobians'):
+            total[key] += record[key]
+        for name, seconds in record['seconds'].items():
+            total['seconds'][name] += seconds
+        for name, calls in record['calls'].items():
+            total['calls'][name] += calls
+    total['seconds'] = dict(total['seconds'])
+    total['calls'] = dict(total['calls'])
+    return total
@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.special import wofz
+
+from faddeeva_kernels import njit, prange
+
+
+# Default location of the table; all processes using the same file share one copy through
+# the page cache, as the table is memory-mapped read-only.
+DEFAULT_TABLE_PATH = os.environ.get(
+    "ASTROVOIGTFIT_VOIGT_TABLE",
+    os.path.join(os.path.expanduser("~"), ".cache", "astrovoigtfit", "voigt_table.npy"),
+)
+
+# Maximum relative error of H(a, u) = Re[w(u + ia)] against scipy.special.wofz for the
+# default table (log10 a in [-6, 1] step 0.02, u in [0, 15] step 0.01), measured inside
+# the table range; outside the range wofz is called directly. Im[w] has an absolute error
+# below 1e-7.
+TABLE_MAX_REL_ERROR = 5e-7
+
+
+def build_table(path=DEFAULT_TABLE_PATH, log_a_min=-6.0, log_a_max=1.0, d_log_a=0.02, u_max=15.0, du=0.01):
+    """
+    Tabulate log H(a, u) and L(a, u) = Im[w(u + ia)] with scipy.special.wofz and save them to
+    path (.npy, shape (2, n_a, n_u)), with the axes in a .json file next to it.
+
+    Args:
+        path (str): Output .npy file
+        log_a_min, log_a_max, d_log_a (float): log10 grid of the damping parameter a
+        u_max, du (float): grid of the offset u >= 0 (H is even and L is odd in u)
+
+    Returns:
+        str: path
+
+    """
+    n_a = int(round((log_a_max - log_a_min) / d_log_a)) + 1
+    n_u = int(round(u_max / du)) + 1
+    a = 10 ** (log_a_min + d_log_a * np.arange(n_a))
+    u = du * np.arange(n_u)
+    w = wofz(u[None, :] + 1j * a[:, None])
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # write to temporary files first, so that concurrent workers never see a partial table;
+    # the axes go first as the .npy file is what marks the table as present
+    axes_path = os.path.splitext(path)[0] + ".json"
+    tmp = f"{axes_path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"log_a_min": log_a_min, "d_log_a": d_log_a, "n_a": n_a, "du": du, "n_u": n_u}, f)
+    os.replace(tmp, axes_path)
+    tmp = f"{path}.{os.getpid()}.tmp.npy"
+    np.save(tmp, np.stack([np.log(np.real(w)), np.imag(w)]))
+    os.replace(tmp, path)
+
+    return path
+
+
+@njit(cache=True)
+def _cubic_weights(t):
+    # 4-point Lagrange weights for the nodes -1, 0, 1, 2
+    return (-t * (t - 1.0) * (t - 2.0) / 6.0,
+            (t + 1.0) * (t - 1.0) * (t - 2.0) / 2.0,
+            -(t + 1.0) * t * (t - 2.0) / 2.0,
+            (t + 1.0) * t * (t - 1.0) / 6.0)
+
+
+@njit(parallel=True, cache=True)
+def _subtable_kernel(rows, u, log_h, imag, du, re_out, im_out):
+    n_u = log_h.shape[1]
+    for n in prange(u.size):
+        x = abs(u[n])
+        i = min(max(int(x / du), 1), n_u - 3)
+        w0, w1, w2, w3 = _cubic_weights(x / du - i)
+        r = rows[n]
+        re_out[n] = np.exp(w0 * log_h[r, i - 1] + w1 * log_h[r, i] + w2 * log_h[r, i + 1] + w3 * log_h[r, i + 2])
+        l_value = w0 * imag[r, i - 1] + w1 * imag[r, i] + w2 * imag[r, i + 1] + w3 * imag[r, i + 2]
+        im_out[n] = l_value if u[n] >= 0 else -l_value
+
+
+class VoigtTable:
+    """
+    Memory-mapped table of the Voigt function H(a, u) = Re[w(u + ia)] (and Im[w]) with cubic
+    interpolation.
+
+    Lookups are done through per-damping sub-tables: for every distinct a the 2-D table is
+    interpolated (cubic in log10 a) to one 1-D row over u, which is then interpolated (cubic
+    in u) for every point. Within a line a is constant, so a fit only ever needs a handful of
+    rows. The rows are kept in a least recently used cache limited to max_bytes, guarded by a
+    lock so that threads (e.g. those of fit_server) can share one table.
+
+    Args:
+        path (str): .npy file written by build_table (memory-mapped read-only)
+        max_bytes (int): size limit of the sub-table cache
+
+    """
+
+    def __init__(self, path=DEFAULT_TABLE_PATH, max_bytes=32 * 2 ** 20):
+        with open(os.path.splitext(path)[0] + ".json") as f:
+            axes = json.load(f)
+        self.path = path
+        self.table = np.load(path, mmap_mode="r")
+        self.log_a_min = axes["log_a_min"]
+        self.d_log_a = axes["d_log_a"]
+        self.n_a = axes["n_a"]
+        self.du = axes["du"]
+        self.n_u = axes["n_u"]
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_rows(self):
+        return max(1, self.max_bytes // (2 * self.n_u * 8))
+
+    def subtable(self, a):
+        """(log H, Im w) over the u grid for damping a, from the LRU cache."""
+        with self._lock:
+            row = self._rows.get(a)
+            if row is not None:
+                self.hits += 1
+                self._rows.move_to_end(a)
+                return row
+            self.misses += 1
+
+        s = (np.log10(a) - self.log_a_min) / self.d_log_a
+        k = min(max(int(s), 1), self.n_a - 3)
+        weights = np.array(_cubic_weights(s - k))
+        row = np.tensordot(weights, self.table[:, k - 1:k + 3, :], axes=([0], [1]))
+        with self._lock:
+            self._rows[a] = row
+            while len(self._rows) > self.max_rows:
+                self._rows.popitem(last=False)
+        return row
+
+    def faddeeva(self, x, y):
+        """Re and Im of w(x + iy), as faddeeva.faddeeva; points outside the table use wofz."""
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        shape = x.shape
+        x = x.ravel()
+        y = y.ravel()
+        re = np.empty(x.size)
+        im = np.empty(x.size)
+
+        log_a = np.log10(np.maximum(y, 1e-300))
+        inside = ((np.abs(x) <= (self.n_u - 3) * self.du)
+                  & (log_a >= self.log_a_min + self.d_log_a)
+                  & (log_a <= self.log_a_min + (self.n_a - 3) * self.d_log_a))
+
+        if np.any(inside):
+            a_values, rows = np.unique(y[inside], return_inverse=True)
+            subtables = np.stack([self.subtable(a) for a in a_values])
+            re_in = np.empty(rows.size)
+            im_in = np.empty(rows.size)
+            _subtable_kernel(rows.astype(np.int64), x[inside], np.ascontiguousarray(subtables[:, 0]),
+                             np.ascontiguousarray(subtables[:, 1]), self.du, re_in, im_in)
+            re[inside] = re_in
+            im[inside] = im_in
+
+        outside = ~inside
+        if np.any(outside):
+            w = wofz(x[outside] + 1j * y[outside])
+            re[outside] = np.real(w)
+            im[outside] = np.imag(w)
+
+        return re.reshape(shape), im.reshape(shape)
+
+
+_default_table = None
+_default_table_lock = threading.Lock()
+
+
+def default_table():
+    """The shared VoigtTable at DEFAULT_TABLE_PATH, built on first use if the file is missing."""
+    global _default_table
+    with _default_table_lock:
+        if _default_table is None:
+            if not os.path.exists(DEFAULT_TABLE_PATH):
+                build_table(DEFAULT_TABLE_PATH)
+            _default_table = VoigtTable(DEFAULT_TABLE_PATH)
+    return _default_table
@@ -0,0 +1,226 @@
+"""
+Benchmark suite of the forward model and the fit.
+
+Every benchmark is timed while one parameter (number of lines, clouds, grid pixels or
+v_resolution) is swept around a baseline, on synthetic spectra with known parameters (see
+synthetic.py). Every run appends its timings, tagged with the git commit, to
+benchmarks/results/<machine>.jsonl, so that changes show up as shifted scaling curves.
+
+Usage:
+    python benchmarks/run_benchmarks.py                   # run everything
+    python benchmarks/run_benchmarks.py --quick           # fewer repeats, for a quick check
+    python benchmarks/run_benchmarks.py -k mother_function
+    python benchmarks/run_benchmarks.py --compare <rev>   # ratio to the stored results of <rev>
+    python benchmarks/run_benchmarks.py --plot            # scaling curves of every stored commit
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import synthetic_spectrum, initial_guess  # noqa: E402
+from other_functions import voigt_optical_depth  # noqa: E402
+from model import master_function  # noqa: E402
+from astrovoigtfit import astro_voigt_fit  # noqa: E402
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+BASELINE = {'n_lines': 2, 'n_clouds': 2, 'n_pixels': 2000, 'v_resolution': 3.0}
+
+# parameter -> values swept (the other parameters are kept at BASELINE)
+SWEEPS = {
+    'n_lines': [1, 2, 4, 8, 16, 32],
+    'n_clouds': [1, 2, 4, 8],
+    'n_pixels': [500, 1000, 2000, 4000, 8000, 16000],
+    'v_resolution': [1.0, 3.0, 7.5],
+}
+# full fits are slow, so their sweeps are shorter
+FIT_SWEEPS = {
+    'n_lines': [1, 2, 4],
+    'n_clouds': [1, 2, 3],
+    'n_pixels': [1000, 2000, 4000],
+    'v_resolution': [1.0, 3.0, 7.5],
+}
+
+
+def bench_voigt_optical_depth(n_lines, n_clouds, n_pixels, v_resolution):
+    # one line on the whole grid; only n_pixels matters
+    wavegrid, _, _ = synthetic_spectrum(1, 1, n_pixels, v_resolution)
+    return lambda: voigt_optical_depth(wavegrid, lambda0=4232.0, b=2.0, N=1e13, f=0.00545, gamma=1e8)
+
+
+def bench_mother_function(n_lines, n_clouds, n_pixels, v_resolution):
+    wavegrid, _, truth = synthetic_spectrum(n_lines, n_clouds, n_pixels, v_resolution)
+    species = truth[0]
+    kwargs = {f'{key}_1st': species[key] for key in ('lambda', 'f', 'gamma', 'b', 'N', 'v_rad')}
+    return lambda: master_function(wavegrid, v_resolution=v_resolution, **kwargs)
+
+
+def bench_astro_voigt_fit(n_lines, n_clouds, n_pixels, v_resolution, jacobian=None):
+    wavegrid, flux, truth = synthetic_spectrum(n_lines, n_clouds, n_pixels, v_resolution)
+
+    def run():
+        return astro_voigt_fit(wavegrid, flux, initial_guess(truth), v_resolution=v_resolution,
+                               std_dev=0.002, jacobian=jacobian)
+
+    def check(result):
+        # relative error of the fitted column densities, to catch fast but wrong fits
+        N = np.array([result.params[f'N_0_{i}'].value for i in range(n_clouds)])
+        return {'nfev': result.nfev, 'N_rel_error': float(np.max(np.abs(N / truth[0]['N'] - 1)))}
+
+    return run, check
+
+
+def bench_astro_voigt_fit_analytic(n_lines, n_clouds, n_pixels, v_resolution):
+    return bench_astro_voigt_fit(n_lines, n_clouds, n_pixels, v_resolution, jacobian='analytic')
+
+
+BENCHMARKS = {
+    'voigt_optical_depth': (bench_voigt_optical_depth, {'n_pixels': SWEEPS['n_pixels']}),
+    'mother_function': (bench_mother_function, SWEEPS),
+    'astro_voigt_fit': (bench_astro_voigt_fit, FIT_SWEEPS),
+    'astro_voigt_fit_analytic': (bench_astro_voigt_fit_analytic, FIT_SWEEPS),
+}
+
+
+def time_call(func, repeat=5, min_time=0.2):
+    """Best time per call (s) out of repeat runs of timeit, each lasting at least min_time."""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    number = max(1, int(np.ceil(number * min_time / max(elapsed, 1e-9))))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def time_fit(func, repeat=3):
+    """Best time (s) out of repeat calls, and the result of the last call."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def git_commit(rev='HEAD'):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', rev], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def results_file():
+    return os.path.join(RESULTS_DIR, platform.node() + '.jsonl')
+
+
+def run(keyword=None, quick=False):
+    commit = git_commit()
+    date = time.strftime('%Y-%m-%dT%H:%M:%S')
+    records = []
+    for name, (bench, sweeps) in BENCHMARKS.items():
+        if keyword is not None and keyword not in name:
+            continue
+        for parameter, values in sweeps.items():
+            for value in values:
+                params = dict(BASELINE, **{parameter: value})
+                setup = bench(**params)
+                func, check = setup if isinstance(setup, tuple) else (setup, None)
+                record = {'benchmark': name, 'sweep': parameter, 'params': params, 'commit': commit,
+                          'date': date}
+                if check is None:
+                    seconds = time_call(func, repeat=2 if quick else 5, min_time=0.05 if quick else 0.2)
+                else:
+                    # a fit takes long enough to be timed on its own
+                    seconds, result = time_fit(func, repeat=1 if quick else 3)
+                    record.update(check(result))
+                record['seconds'] = seconds
+                records.append(record)
+                print(f"{name:26s} {parameter:>12s} = {value:<8g} {seconds * 1e3:10.3f} ms")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(results_file(), 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return records
+
+
+def load_results():
+    if not os.path.exists(results_file()):
+        return []
+    with open(results_file()) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _key(record):
+    return record['benchmark'], record['sweep'], record['params'][record['sweep']]
+
+
+def latest(records, commit=None):
+    """The most recent timing of every (benchmark, sweep, value), optionally of one commit only."""
+    best = {}
+    for record in records:
+        if commit is None or record['commit'].startswith(commit):
+            best[_key(record)] = record
+    return best
+
+
+def compare(rev):
+    """Print the timings of the current commit relative to those stored for rev."""
+    records = load_results()
+    old = latest(records, git_commit(rev))
+    new = latest(records, git_commit())
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key]['seconds'] / old[key]['seconds']
+        flag = '  SLOWER' if ratio > 1.1 else ('  faster' if ratio < 0.9 else '')
+        print(f"{key[0]:26s} {key[1]:>12s} = {key[2]:<8g} {ratio:6.2f}x{flag}")
+
+
+def plot(path=None):
+    """Scaling curves (time against every swept parameter) of every stored commit."""
+    import matplotlib.pyplot as plt
+
+    records = load_results()
+    panels = sorted({(r['benchmark'], r['sweep']) for r in records})
+    commits = list(dict.fromkeys(r['commit'] for r in records))
+    fig, axes = plt.subplots(len(panels), 1, figsize=(6, 2.5 * len(panels)), squeeze=False)
+    for ax, (name, sweep) in zip(axes[:, 0], panels):
+        for commit in commits:
+            points = sorted((k[2], r['seconds']) for k, r in latest(records, commit).items()
+                            if k[:2] == (name, sweep))
+            if points:
+                x, y = zip(*points)
+                ax.loglog(x, np.array(y) * 1e3, 'o-', label=commit)
+        ax.set_title(name, fontsize=9)
+        ax.set_xlabel(sweep)
+        ax.set_ylabel('ms')
+    axes[0, 0].legend(fontsize=7)
+    fig.tight_layout()
+    if path is None:
+        plt.show()
+    else:
+        fig.savefig(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', help='only run benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='fewer repeats')
+    parser.add_argument('--compare', metavar='REV', help='compare HEAD to the stored results of REV')
+    parser.add_argument('--plot', nargs='?', const='', metavar='FILE', help='plot the scaling curves')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+    elif args.plot is not None:
+        plot(args.plot or None)
+    else:
+        run(args.keyword, args.quick)
@@ -0,0 +1,63 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'astrovoightfit', 'utils'))
+
+from model import master_function  # noqa: E402
+
+
+def synthetic_spectrum(n_lines=2, n_clouds=2, n_pixels=2000, v_resolution=3.0, noise=0.002,
+                       seed=0):
+    """
+    Synthetic normalised spectrum of one species with known parameters, made with master_function.
+
+    The n_lines transitions are spread evenly over the middle of a 6 AA window around 4232 AA
+    (sampled with n_pixels pixels), and every transition is seen in n_clouds clouds spaced by
+    15 km/s.
+
+    Args:
+        n_lines (int): Number of transitions
+        n_clouds (int): Number of velocity components
+        n_pixels (int): Number of pixels of the wavelength grid
+        v_resolution (float): Instrumental resolution (FWHM), in km/s
+        noise (float): Standard deviation of the Gaussian noise added to the flux
+        seed (int): Seed of the noise
+
+    Returns:
+        tuple: (wavegrid, flux, species_params), with species_params holding the true
+        parameters in the format used by astro_voigt_fit
+
+    """
+
+    wavegrid = np.linspace(4229.0, 4235.0, n_pixels)
+    lambda0 = np.linspace(4230.0, 4234.0, n_lines + 2)[1:-1]
+    species = {
+        'lambda': lambda0.tolist(),
+        'f': [0.00545] * n_lines,
+        'gamma': [1e8] * n_lines,
+        'b': np.linspace(1.5, 2.5, n_clouds).tolist(),
+        'N': np.geomspace(1e13, 3e12, n_clouds).tolist(),
+        'v_rad': (15.0 * (np.arange(n_clouds) - (n_clouds - 1) / 2)).tolist(),
+    }
+
+    flux = master_function(wavegrid, v_resolution=v_resolution, lambda_1st=species['lambda'],
+                           f_1st=species['f'], gamma_1st=species['gamma'], b_1st=species['b'],
+                           N_1st=species['N'], v_rad_1st=species['v_rad'])
+    flux = flux + np.random.default_rng(seed).normal(0.0, noise, n_pixels)
+
+    return wavegrid, flux, {0: species}
+
+
+def initial_guess(species_params, seed=1):
+    """Copy of species_params with b, N and v_rad perturbed, as a starting point for a fit."""
+    rng = np.random.default_rng(seed)
+    guess = {}
+    for species_idx, species in species_params.items():
+        guess[species_idx] = dict(species)
+        n_clouds = len(species['N'])
+        guess[species_idx]['b'] = (np.asarray(species['b']) * rng.uniform(0.8, 1.2, n_clouds)).tolist()
+        guess[species_idx]['N'] = (np.asarray(species['N']) * rng.uniform(0.5, 2.0, n_clouds)).tolist()
+        guess[species_idx]['v_rad'] = (np.asarray(species['v_rad']) + rng.uniform(-1.0, 1.0, n_clouds)).tolist()
+    return guess
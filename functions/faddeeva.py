@@ -0,0 +1,15 @@
+"""
+Faddeeva function backends of voigt_profile.
+
+The implementation is astrovoightfit/utils/faddeeva.py (numba kernels in faddeeva_kernels,
+compiled on first use); this module only makes it importable as functions.faddeeva.
+"""
+import os
+import sys
+
+# the fitting code in astrovoightfit/utils uses flat imports (``from faddeeva_kernels import ...``)
+_UTILS = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'astrovoightfit', 'utils'))
+if _UTILS not in sys.path:
+    sys.path.insert(0, _UTILS)
+
+from faddeeva import BACKEND_MAX_REL_ERROR, faddeeva  # noqa: E402,F401
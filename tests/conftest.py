@@ -0,0 +1,9 @@
+import os
+import sys
+
+# the fitting code in astrovoightfit/utils uses flat imports (``from model import ...``)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'astrovoightfit', 'utils'))
+
+# the process pools fork this process after earlier tests ran the parallel numba kernels; with
+# the tbb threading layer the process then hangs at exit (workqueue is not thread safe)
+os.environ.setdefault('NUMBA_THREADING_LAYER', 'omp')
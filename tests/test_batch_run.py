@@ -0,0 +1,56 @@
+import os
+import time
+import batch_run
+from batch_run import fit_many, job_key, read_checkpoint
+
+
+def _jobs(n):
+  return [{'star': 'HD 183143', 'molecule': ['12CH+_4232'], 'file_no': k, 'wave_range': [4231.5, 4233.5]}
+          for k in range(n)]
+
+
+def _fake_fit_job(log):
+  # a cheap stand-in for fit_job: records every call and finishes the later jobs first
+  def fit_job(job):
+    with open(log, 'a') as f:
+      f.write(job_key(job) + '\n')
+    time.sleep(0.05 * (5 - job['file_no'] % 5))
+    if job.get('fail'):
+      raise RuntimeError('no spectrum')
+    return {'key': job_key(job), 'redchi': 1.0 + job['file_no']}
+  return fit_job
+
+
+def test_fit_many_resume(tmp_path, monkeypatch):
+  log, checkpoint = tmp_path / 'calls.log', str(tmp_path / 'fits.jsonl')
+  monkeypatch.setattr(batch_run, 'fit_job', _fake_fit_job(log))
+  jobs = _jobs(6)
+  # the first run dies after three jobs (failed jobs are not checkpointed)
+  first = list(fit_many(jobs[:3] + [dict(jobs[3], fail=True)], n_workers=2, checkpoint=checkpoint))
+  assert sum('error' in record for record in first) == 1
+  stored = read_checkpoint(checkpoint)
+  assert stored == {record['key']: record for record in first if 'error' not in record}
+  # a truncated last line (crash while writing) is ignored
+  with open(checkpoint, 'a') as f:
+    f.write('{"key": "HD 1')
+  assert read_checkpoint(checkpoint) == stored
+
+  os.remove(log)
+  records = list(fit_many(jobs, n_workers=2, checkpoint=checkpoint))
+  # only the jobs missing from the checkpoint are fitted again
+  assert sorted(log.read_text().split('\n')[:-1]) == sorted(job_key(job) for job in jobs[3:])
+  assert sorted(record['key'] for record in records) == sorted(job_key(job) for job in jobs)
+  # and the resumed records are readable despite the truncated line before them
+  assert sorted(read_checkpoint(checkpoint)) == sorted(job_key(job) for job in jobs)
+
+
+def test_fit_many_ordered(tmp_path, monkeypatch):
+  monkeypatch.setattr(batch_run, 'fit_job', _fake_fit_job(tmp_path / 'calls.log'))
+  jobs = _jobs(5)
+  checkpoint = str(tmp_path / 'fits.jsonl')
+  list(fit_many(jobs[1:2], n_workers=1, checkpoint=checkpoint))
+  records = list(fit_many(jobs, n_workers=3, checkpoint=checkpoint, ordered=True))
+  assert [record['key'] for record in records] == [job_key(job) for job in jobs]
+  # without ordered the later (faster) jobs come back first
+  unordered = [record['key'] for record in fit_many(jobs, n_workers=3)]
+  assert sorted(unordered) == sorted(job_key(job) for job in jobs) and unordered != [job_key(job) for job in jobs]
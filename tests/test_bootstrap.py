@@ -0,0 +1,31 @@
+import numpy as np
+from astrovoigtfit import astro_voigt_fit
+from bootstrap import bootstrap_uncertainties, resample
+from model import master_function
+
+
+def test_resample():
+  residual = np.arange(10.0)
+  weights = np.full(10, 2.0)
+  draw = resample(residual, weights, np.random.default_rng(0), block_size=3)
+  # blocks of 3 consecutive (centred) residuals
+  steps = np.diff(draw)[[0, 1, 3, 4, 6, 7]]
+  assert draw.size == 10 and np.allclose(steps, 1.0)
+
+
+def test_bootstrap_uncertainties():
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[0.0])
+  ydata = ydata + np.random.default_rng(0).normal(0, 0.002, wavegrid.size)
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.5], 'N': [5e12], 'v_rad': [1.0]}}
+  result = astro_voigt_fit(wavegrid, ydata, species, v_resolution=3.0, std_dev=0.002, jacobian='analytic')
+  boot = bootstrap_uncertainties(result, n_boot=40, n_workers=1, seed=1)
+  assert boot['samples'].shape == (40 - boot['n_failed'], 3) and boot['n_failed'] == 0
+  for name in ('b_0_0', 'N_0_0', 'v_rad_0_0'):
+    low, high = boot['intervals'][name]
+    assert low < result.params[name].value < high
+    # agrees with the covariance error for this well constrained line
+    assert 0.5 < boot['std'][name] / result.params[name].stderr < 2
+  parallel = bootstrap_uncertainties(result, n_boot=8, n_workers=2, seed=1)
+  assert np.allclose(parallel['samples'], boot['samples'][:8])
@@ -0,0 +1,41 @@
+import numpy as np
+from model import master_function
+from component_selection import astro_voigt_autocomponents, candidate_velocities
+
+
+def _two_clouds():
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0, 2.0], N_1st=[1e13, 5e12], v_rad_1st=[-10.0, 10.0])
+  return wavegrid, ydata + np.random.default_rng(0).normal(0, 0.002, wavegrid.size)
+
+
+def test_candidate_velocities():
+  wavegrid, ydata = _two_clouds()
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8]}}
+  velocities = candidate_velocities(species, wavegrid, ydata - 1.0, n_troughs=2)
+  assert np.allclose(sorted(velocities), [-10.0, 10.0], atol=1.0)
+
+
+def test_autocomponents():
+  wavegrid, ydata = _two_clouds()
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8]}}
+  result = astro_voigt_autocomponents(wavegrid, ydata, species, max_components=3, n_workers=1,
+                                      v_resolution=3.0, std_dev=0.002)
+  levels = result.component_selection
+  assert [level['n_components'] for level in levels] == [1, 2, 3]
+  assert min(levels, key=lambda level: level['bic'])['n_components'] == 2
+  assert np.allclose(sorted([result.params['v_rad_0_0'].value, result.params['v_rad_0_1'].value]),
+                     [-10.0, 10.0], atol=0.5)
+
+
+def test_autocomponents_continuum():
+  # the same clouds on a sloped continuum, fitted together with it
+  wavegrid, ydata = _two_clouds()
+  ydata = ydata * (2.0 + 0.3 * (wavegrid - 4232.5))
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8]}}
+  result = astro_voigt_autocomponents(wavegrid, ydata, species, max_components=3, n_workers=1,
+                                      v_resolution=3.0, std_dev=0.004, continuum_degree=1)
+  assert min(result.component_selection, key=lambda level: level['bic'])['n_components'] == 2
+  assert np.allclose(sorted([result.params['v_rad_0_0'].value, result.params['v_rad_0_1'].value]),
+                     [-10.0, 10.0], atol=0.5)
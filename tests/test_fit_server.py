@@ -0,0 +1,50 @@
+import threading
+import numpy as np
+import pytest
+from fit_server import FitService, make_server, request
+from model import master_function
+
+
+@pytest.fixture
+def url():
+  server = make_server(port=0, service=FitService(n_workers=1, max_queue=2))
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield f'http://127.0.0.1:{server.server_address[1]}'
+  server.shutdown()
+  server.server_close()
+
+
+def test_fit_service(url):
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[0.0])
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.5], 'N': [5e12], 'v_rad': [1.0]}}
+  record = request('/fit', {'wavegrid': wavegrid, 'ydata': ydata, 'species_params': species,
+                            'v_resolution': 3.0, 'std_dev': 0.002, 'jacobian': 'analytic'}, url=url)
+  assert record['success'] and abs(record['params']['N_0_0'] / 1e13 - 1) < 1e-3
+  assert len(record['best_fit']) == wavegrid.size
+
+  reply = request('/continuum', {'wavelength': wavegrid, 'flux': 2 * ydata, 'absorption_range': [4232.0, 4232.6],
+                                 'degree': 1}, url=url)
+  assert np.allclose(reply['coefficients'], [2, 0], atol=1e-6)
+  assert request('/health', url=url)['served'] == 2
+
+  with pytest.raises(RuntimeError, match='404'):
+    request('/unknown', {}, url=url)
+  with pytest.raises(RuntimeError, match='Unknown fit arguments'):
+    request('/fit', {'wavegrid': wavegrid, 'ydata': ydata, 'species_params': species, 'profile': True}, url=url)
+
+
+def test_fit_service_restrictions(url):
+  job = {'star': 'HD 183143', 'molecule': ['CH+'], 'file_no': 0, 'wave_range': [4231, 4234],
+         'absorption_range': [4232, 4232.6], 'species_params': {}}
+  with pytest.raises(RuntimeError, match='species_file cannot be set'):
+    request('/job', dict(job, species_file='/etc/passwd'), url=url)
+  with pytest.raises(RuntimeError, match='Unknown fit arguments'):
+    request('/job', dict(job, fit_kwargs={'profile': True}), url=url)
+
+  with pytest.raises(ValueError, match='allow_remote'):
+    make_server('0.0.0.0', port=0)
+  server = make_server('0.0.0.0', port=0, service=FitService(n_workers=1), allow_remote=True)
+  server.server_close()
+  server.RequestHandlerClass.service.pool.shutdown()
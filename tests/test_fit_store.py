@@ -0,0 +1,32 @@
+import numpy as np
+import fit_store
+from model import master_function
+from astrovoigtfit import astro_voigt_fit
+
+
+def test_warm_start(tmp_path, monkeypatch):
+  monkeypatch.setattr(fit_store, 'STORE_PATH', str(tmp_path / 'fits.sqlite'))
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0, 1.5], N_1st=[1e13, 4e12], v_rad_1st=[-5.0, 8.0])
+  ydata = ydata + np.random.default_rng(0).normal(0, 0.002, wavegrid.size)
+
+  def guess():
+    return {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [3.0, 3.0], 'N': [1e12, 1e12],
+                'v_rad': [-2.0, 4.0]}}
+
+  key = ('HD 183143', 'file_0.fits', ('12CH+_4032',), (4231.5, 4233.5))
+  cold = astro_voigt_fit(wavegrid, ydata, guess(), v_resolution=3.0, std_dev=0.002, store_key=key)
+  assert cold.warm_start is None
+  warm = astro_voigt_fit(wavegrid, ydata, guess(), v_resolution=3.0, std_dev=0.002, store_key=key)
+  assert warm.warm_start == 'exact' and warm.nfev < cold.nfev / 2
+  assert abs(warm.params['N_0_0'].value / cold.params['N_0_0'].value - 1) < 1e-3
+
+  # another exposure of the same target starts from the stored fit as well
+  seeded, source = fit_store.seed(guess(), ('HD 183143', 'file_1.fits', ('12CH+_4032',), (4231.5, 4233.5)))
+  assert source == 'neighbour' and np.isclose(seeded[0]['N'][0], warm.params['N_0_0'].value)
+  # but not another window or a different number of components
+  assert fit_store.seed(guess(), key[:3] + ((4231.0, 4234.0),))[1] is None
+  three = guess()
+  three[0].update(b=[2.0] * 3, N=[1e12] * 3, v_rad=[-5.0, 0.0, 8.0])
+  assert fit_store.seed(three, key)[0] == three
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+UTILS = os.path.join(os.path.dirname(__file__), '..', 'astrovoightfit', 'utils')
+
+# cumulative `python -X importtime` budget of `import astrovoigtfit` (about 0.4 s when this
+# was set, 2 s with matplotlib, pandas, astropy, numba and lmfit imported up front)
+IMPORT_BUDGET_SECONDS = 1.0
+
+# loaded on first use only: plotting, EDIBLES I/O, the numba backends and lmfit
+LAZY_MODULES = ('matplotlib', 'pandas', 'astropy', 'numba', 'edibles', 'lmfit')
+
+
+def _import(module):
+  code = f"import sys, {module}; print(','.join(sorted(set(m.split('.')[0] for m in sys.modules))))"
+  env = dict(os.environ, PYTHONPATH=os.path.abspath(UTILS))
+  return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, capture_output=True,
+                        text=True, check=True)
+
+
+def _cumulative_seconds(stderr, module):
+  # lines look like "import time:  self [us] | cumulative | imported package"
+  for line in stderr.splitlines():
+    fields = line.split('|')
+    if len(fields) == 3 and fields[2].strip() == module:
+      return int(fields[1]) * 1e-6
+  raise AssertionError(f'{module} not in -X importtime output')
+
+
+def test_import_footprint():
+  for module in ('astrovoigtfit', 'main_run'):
+    loaded = set(_import(module).stdout.strip().split(','))
+    assert not loaded & set(LAZY_MODULES), f'{module} imports {sorted(loaded & set(LAZY_MODULES))}'
+
+
+def test_import_time():
+  # best of three, to be robust against a busy machine
+  seconds = min(_cumulative_seconds(_import('astrovoigtfit').stderr, 'astrovoigtfit') for _ in range(3))
+  assert seconds < IMPORT_BUDGET_SECONDS, f'import astrovoigtfit took {seconds:.2f} s'
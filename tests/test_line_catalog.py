@@ -0,0 +1,48 @@
+import os
+import numpy as np
+from line_catalog import LineCatalog, load_catalog, read_delimited, read_species_file
+
+SPECIES_FILE = os.path.join(os.path.dirname(__file__), '..', 'astrovoightfit', 'utils', 'species.txt')
+
+
+def test_species_file(tmp_path):
+  catalog = LineCatalog(read_species_file(SPECIES_FILE))
+  assert len(catalog) == 6
+  assert catalog.reference_line('7Li_6707') == 6707
+  assert catalog.species_params('6Li_6707') == {'lambda': [6707.921, 6708.072], 'f': [0.4982, 0.2491],
+                                                'gamma': [3.69e7, 3.69e7]}
+  assert 'CH_4300' not in catalog
+
+  lines = catalog.in_range(6707.8, 6708.0, f_min=0.3)
+  assert lines['species'].tolist() == ['6Li_6707']
+  assert np.all(np.diff(catalog.in_range(0, np.inf)['wavelength']) >= 0)
+
+  catalog.save(str(tmp_path / 'catalog.npz'))
+  loaded = load_catalog(str(tmp_path / 'catalog.npz'))
+  assert np.array_equal(loaded.species('12CH+_4032'), catalog.species('12CH+_4032'))
+
+
+def test_read_delimited(tmp_path):
+  # VALD style: quoted species, wavelengths in Angstrom, log gf and the lower level degeneracy
+  vald = tmp_path / 'vald.csv'
+  vald.write_text("Species, Wavelength, log_gf, g_lower, Gamma\n"
+                  "'Li 1', 6707.9145, -0.303, 2, 3.69e7\n"
+                  "'Li 1', 6707.7635, -0.002, 2, 3.69e7\n"
+                  "'Na 1', 5889.951, 0.108, 2, 6.16e7\n")
+  rows = read_delimited(str(vald), {'species': 'Species', 'wavelength': 'Wavelength', 'log_gf': 'log_gf',
+                                    'g_lower': 'g_lower', 'gamma': 'Gamma'})
+  assert rows['species'].tolist() == ['Li 1', 'Li 1', 'Na 1']
+  assert np.allclose(rows['f'], 10 ** np.array([-0.303, -0.002, 0.108]) / 2)
+  assert np.allclose(rows['gamma'], [3.69e7, 3.69e7, 6.16e7])
+  # without a line column, the reference line is the shortest wavelength of the species
+  assert rows['line'].tolist() == [6707.7635, 6707.7635, 5889.951]
+  assert LineCatalog(rows).species_params('Li 1')['lambda'] == [6707.7635, 6707.9145]
+
+  # HITRAN style: one species, vacuum wavenumbers in cm^-1, f values, another delimiter
+  hitran = tmp_path / 'hitran.csv'
+  hitran.write_text("nu;f;gamma_rad;ref\n23596.7;0.00545;1e8;4232\n24795.2;0.0029;1e8;4232\n")
+  rows = read_delimited(str(hitran), {'wavelength': 'nu', 'f': 'f', 'gamma': 'gamma_rad', 'line': 'ref'},
+                        species='12CH+', delimiter=';', wavenumber=True)
+  assert rows['species'].tolist() == ['12CH+', '12CH+']
+  assert np.allclose(rows['wavelength'], [1e8 / 23596.7, 1e8 / 24795.2])
+  assert rows['f'].tolist() == [0.00545, 0.0029] and rows['line'].tolist() == [4232, 4232]
@@ -0,0 +1,314 @@
+import numpy as np
+from other_functions import voigt_optical_depth, voigt_optical_depth_grid
+
+
+def test_optical_depth_grid():
+  refgrid = np.linspace(4231.5, 4233.5, 2001)
+  lambda0 = np.array([4232.288, 4232.548])
+  tau = voigt_optical_depth_grid(refgrid, lambda0, [0.00545, 0.00545], [1e8, 1e8],
+                                 [2.0, 1.5], [1e12, 1e13], [0.0, 0.0], v_resolution=3.0)
+  expected = sum(voigt_optical_depth(refgrid, lambda0=l, b=b, N=N, f=0.00545, gamma=1e8)
+                 for l, b, N in zip(lambda0, [2.0, 1.5], [1e12, 1e13]))
+  assert np.allclose(tau, expected, rtol=1e-10, atol=1e-4 * expected.max())
+
+
+
+def test_chunked_optical_depth():
+  from other_functions import line_windows, line_window_chunks
+  from model import mother_function
+  rng = np.random.default_rng(0)
+  refgrid = np.linspace(4225.0, 4240.0, 20000)
+  lines = dict(lambda0=rng.uniform(4226, 4239, 60), f=np.full(60, 0.005), gamma=np.full(60, 1e8),
+               b=rng.uniform(1, 3, 60), N=np.full(60, 1e13), v_rad=rng.uniform(-10, 10, 60))
+  windows = (refgrid, lines['lambda0'], lines['gamma'], lines['b'], lines['v_rad'], 3.0)
+  chunks = list(line_window_chunks(*windows, max_pairs=1000))
+  assert max(line_idx.size for line_idx, _ in chunks) == 1000
+  assert all(np.array_equal(np.concatenate(parts), full)
+             for parts, full in zip(zip(*chunks), line_windows(*windows)))
+  # the same sums in the same order: identical, not just close
+  assert np.array_equal(voigt_optical_depth_grid(refgrid, v_resolution=3.0, max_memory=10000, **lines),
+                        voigt_optical_depth_grid(refgrid, v_resolution=3.0, **lines))
+  assert np.array_equal(mother_function(refgrid, v_resolution=3.0, max_memory=10000, **lines),
+                        mother_function(refgrid, v_resolution=3.0, **lines))
+
+
+def test_reference_segments():
+  from model import mother_function
+  from profiling import profile
+  # CH+ at 4232 AA and Li at 6707 AA in one model: two short segments, not one grid between them
+  ch, li = np.linspace(4231.5, 4233.5, 800), np.linspace(6706.5, 6708.8, 900)
+  lines = dict(lambda0=np.array([4232.288, 6707.76, 6707.91]), f=np.array([0.00545, 0.498, 0.249]),
+               gamma=np.array([1e8, 3.7e7, 3.7e7]), b=np.array([2.0, 1.0, 1.0]),
+               N=np.array([1e13, 1e10, 1e10]), v_rad=np.array([-5.0, -5.0, -5.0]))
+  with profile() as p:
+    model = mother_function(np.concatenate([ch, li]), v_resolution=3.0, **lines)
+  assert len(p.n_v) == 2 and sum(p.n_v) < 5000
+  separate = [mother_function(grid, v_resolution=3.0, **{key: value[k] for key, value in lines.items()})
+              for grid, k in ((ch, [0]), (li, [1, 2]))]
+  assert np.allclose(model, np.concatenate(separate), atol=1e-4)
+
+
+def test_lattice_segments():
+  from model import ModelPlan
+  from profiling import profile
+  # the same gapped CH+ / Li grid through ModelPlan: one lattice and operator per segment
+  ch, li = np.linspace(4231.5, 4233.5, 800), np.linspace(6706.5, 6708.8, 900)
+  wavegrid = np.concatenate([ch, li])
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.0], 'N': [1e13], 'v_rad': [-5.0]},
+             1: {'lambda': [6707.76, 6707.91], 'f': [0.498, 0.249], 'gamma': [3.7e7, 3.7e7], 'b': [1.0],
+                 'N': [1e10], 'v_rad': [-5.0]}}
+  plan = ModelPlan(wavegrid, species, v_resolution=3.0)
+  theta = plan.initial_theta(species)
+  with profile() as p:
+    model = plan.evaluate(theta)
+  assert len(p.n_v) == 2 and sum(p.n_v) < 5000
+  separate = [ModelPlan(grid, {0: species[s]}, v_resolution=3.0) for grid, s in ((ch, 0), (li, 1))]
+  assert np.allclose(model, np.concatenate([sub.evaluate(sub.initial_theta({0: species[s]}))
+                                            for sub, s in zip(separate, (0, 1))]), atol=1e-12)
+  assert np.allclose(plan.jacobian(theta)[0], model, atol=1e-12)
+  assert np.allclose(plan.evaluate_many([theta])[0], model, atol=1e-12)
+  # continuum far from the lines and between the two regions
+  assert np.all(model[np.abs(wavegrid - 4232.218) > 1.0][:100] == 1.0)
+
+
+
+def test_operator_cache_many_segments():
+  from model import ModelPlan
+  from profiling import profile
+  # 12 well separated lines, one lattice segment and operator each: all kept between evaluations
+  lambdas = 4000.0 + 20.0 * np.arange(12)
+  wavegrid = np.arange(3990.0, 4250.0, 0.01)
+  species = {0: {'lambda': lambdas, 'f': np.full(12, 0.01), 'gamma': np.full(12, 1e8), 'b': [2.0],
+                 'N': [1e12], 'v_rad': [0.0]}}
+  plan = ModelPlan(wavegrid, species, v_resolution=3.0)
+  theta = plan.initial_theta(species)
+  with profile() as p:
+    plan.evaluate(theta)
+  assert len(p.n_v) == 12 and plan.operators.misses == 12
+  plan.evaluate(theta)
+  assert plan.operators.hits == 12 and plan.operators.misses == 12
+
+def test_optical_depth_derivatives():
+  from other_functions import voigt_optical_depth_derivatives
+  refgrid = np.linspace(4232.0, 4232.6, 601)
+  line = dict(lambda0=4232.288, f=0.00545, gamma=1e8, b=2.0, N=1e13, v_rad=3.0)
+  _, _, tau, dtau_db, dtau_dN, dtau_dv = voigt_optical_depth_derivatives(refgrid, v_resolution=3.0, **line)
+  assert np.allclose(dtau_dN * line['N'], tau)
+  for name, analytic in (('b', dtau_db), ('v_rad', dtau_dv)):
+    up, down = dict(line), dict(line)
+    up[name] += 1e-5
+    down[name] -= 1e-5
+    numeric = (voigt_optical_depth_grid(refgrid, v_resolution=3.0, **up)
+               - voigt_optical_depth_grid(refgrid, v_resolution=3.0, **down)) / 2e-5
+    assert np.allclose(analytic, numeric, atol=1e-5 * np.abs(numeric).max())
+
+
+def test_broadening_operators():
+  from broadening import gaussian_operator, tabulated_operator
+  from other_functions import fwhm2sigma
+  wavegrid = np.arange(4231.5, 4233.5, 0.02)
+  refgrid = 4231.5 * (1.0 + np.arange(1500) * 0.1 / 299792.458)
+  depth = np.exp(-0.5 * ((refgrid - 4232.5) / 0.03) ** 2)
+  u = np.linspace(-10, 10, 401)
+  lsf = ([4231.0, 4234.0], u, np.tile(np.exp(-0.5 * (u / fwhm2sigma(3.0)) ** 2), (2, 1)))
+  gaussian = gaussian_operator(wavegrid, refgrid, 3.0)
+  tabulated = tabulated_operator(wavegrid, refgrid, lsf)
+  assert np.allclose(gaussian.sum(axis=1), 1.0)
+  assert np.allclose(gaussian @ depth, tabulated @ depth, atol=1e-3)
+
+
+def test_voigt_table(tmp_path):
+  from scipy.special import wofz
+  from voigt_table import VoigtTable, build_table, TABLE_MAX_REL_ERROR
+  table = VoigtTable(build_table(str(tmp_path / 'voigt_table.npy')))
+  x = np.linspace(-20, 20, 4001)
+  for a in (1e-5, 3.7e-3, 0.5, 50.0):
+    re, im = table.faddeeva(x, a)
+    w = wofz(x + 1j * a)
+    assert np.max(np.abs(re / w.real - 1)) < TABLE_MAX_REL_ERROR
+    assert np.max(np.abs(im - w.imag)) < 1e-7
+  table.faddeeva(x, 0.5)
+  assert table.hits == 1 and table.misses == 3
+  # threads (as in fit_server) sharing the row cache of a table holding two rows
+  from concurrent.futures import ThreadPoolExecutor
+  small = VoigtTable(table.path, max_bytes=2 * 2 * table.n_u * 8)
+  a_values = np.geomspace(1e-4, 10, 64)
+  with ThreadPoolExecutor(8) as pool:
+    results = list(pool.map(lambda a: small.faddeeva(x, a)[0], a_values))
+  assert all(np.array_equal(re, table.faddeeva(x, a)[0]) for re, a in zip(results, a_values))
+  assert len(small._rows) == 2
+
+
+def test_cull_lines():
+  from other_functions import cull_lines, line_peak_tau
+  from model import mother_function
+  wavegrid = np.linspace(4231.5, 4233.5, 800)
+  lines = dict(lambda0=np.array([4232.288, 4232.548, 4300.0, 4232.4]), f=np.full(4, 0.00545),
+               gamma=np.full(4, 1e8), b=np.array([2.0, 1.5, 2.0, 2.0]), N=np.array([1e13, 1e12, 1e13, 1e9]),
+               v_rad=np.zeros(4))
+  peak = max(voigt_optical_depth(np.linspace(4232.28, 4232.30, 20001), **{k: v[0] for k, v in lines.items()}))
+  assert peak <= line_peak_tau(*(lines[k] for k in ('lambda0', 'f', 'gamma', 'b', 'N')))[0] <= 1.01 * peak
+
+  outside, weak = cull_lines(wavegrid, v_resolution=3.0, flux_tol=1e-3, **lines)
+  assert outside.tolist() == [False, False, True, False]
+  assert weak.tolist() == [False, False, False, True]
+
+  full = mother_function(wavegrid, v_resolution=3.0, **lines)
+  culled = mother_function(wavegrid, v_resolution=3.0, flux_tol=1e-3, **lines)
+  assert np.max(np.abs(full - culled)) < 1e-3
+
+
+def test_profile():
+  from model import mother_function
+  from profiling import profile
+  wavegrid = np.linspace(4231.5, 4233.5, 800)
+  with profile() as p:
+    for _ in range(3):
+      mother_function(wavegrid, lambda0=4232.288, f=0.00545, gamma=1e8, b=2.0, N=1e13, v_resolution=3.0)
+  record = p.record()
+  assert record['n_evaluations'] == 3 and record['calls']['optical_depth'] == 3
+  assert record['n_v']['min'] > wavegrid.size / 10
+  assert sum(record['seconds'][s] for s in ('culling', 'grid', 'optical_depth', 'broadening', 'interp')) \
+    <= record['seconds']['evaluate'] <= record['total']
+
+
+def test_model_plan_parity():
+  from broadening import gaussian_operator
+  from model import ModelPlan, master_function
+  wavegrid = np.linspace(4231.5, 4233.5, 800)
+  ch = {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8]}
+  doublet = {'lambda': [4232.288, 4232.548], 'f': [0.00545, 0.00272], 'gamma': [1e8, 1e8]}
+  # (species, v_resolution, tolerance against master_function)
+  cases = [({0: dict(ch, b=[2.0], N=[1e12], v_rad=[-3.0])}, 3.0, 1e-4),
+           ({0: dict(doublet, b=[1.5, 3.0], N=[3e12, 1e12], v_rad=[-5.0, 6.0]),
+             1: dict(ch, b=[2.5, 1.0], N=[5e11, 8e11], v_rad=[-5.0, 6.0])}, 3.0, 1e-4),
+           # saturated: gaussian_filter + np.interp in mother_function is off by a few 1e-4
+           ({0: dict(ch, b=[1.0], N=[5e13], v_rad=[0.0])}, 3.0, 1e-3),
+           ({0: dict(ch, b=[3.0], N=[1e14], v_rad=[2.0])}, 2.0, 1e-3)]
+  for species, v_resolution, tol in cases:
+    plan = ModelPlan(wavegrid, species, v_resolution=v_resolution)
+    model = plan.evaluate(plan.initial_theta(species))
+    kwargs = {f'{key}_{suffix}': species[s][key] for s, suffix in zip(species, ('1st', '2nd'))
+              for key in ('lambda', 'f', 'gamma', 'b', 'N', 'v_rad')}
+    assert np.abs(model - master_function(wavegrid, v_resolution=v_resolution, **kwargs)).max() < tol
+    # and against the convolution of the optical depth on a very fine grid
+    fine = np.linspace(4230.5, 4234.5, 100001)
+    tau = sum(voigt_optical_depth_grid(fine, sp['lambda'], sp['f'], sp['gamma'], b, N, v, v_resolution)
+              for sp in species.values() for b, N, v in zip(sp['b'], sp['N'], sp['v_rad']))
+    exact = gaussian_operator(wavegrid, fine, v_resolution) @ np.exp(-tau)
+    assert np.abs(model - exact).max() < 2e-5
+
+
+def test_evaluate_many():
+  from model import ModelPlan
+  wavegrid = np.linspace(4231.5, 4233.5, 800)
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.0, 1.5],
+                 'N': [1e13, 3e12], 'v_rad': [-5.0, 8.0]}}
+  plan = ModelPlan(wavegrid, species, v_resolution=3.0)
+  thetas = plan.initial_theta(species) * np.random.default_rng(0).uniform(0.9, 1.1, (16, 6))
+  models = plan.evaluate_many(thetas)
+  assert models.shape == (16, wavegrid.size)
+  assert np.allclose(models, [plan.evaluate(theta) for theta in thetas], atol=1e-5)
+
+
+def test_tau_cache():
+  from model import ModelPlan
+  wavegrid = np.linspace(4231.5, 4233.5, 800)
+  species = {0: {'lambda': [4232.288, 4232.548], 'f': [0.00545, 0.003], 'gamma': [1e8, 1e8], 'b': [2.0, 1.5],
+                 'N': [1e13, 3e12], 'v_rad': [-5.0, 8.0]}}
+  plan = ModelPlan(wavegrid, species, v_resolution=3.0)
+  uncached = ModelPlan(wavegrid, species, v_resolution=3.0, tau_cache_size=0)
+  assert uncached.tau_cache is None
+  theta = plan.initial_theta(species)
+  assert np.allclose(plan.evaluate(theta), uncached.evaluate(theta), rtol=0, atol=1e-14)
+  assert (plan.tau_cache.hits, plan.tau_cache.misses) == (0, 4)
+  # a step in N rescales the cached profiles of all lines
+  theta[2] *= 1.5
+  assert np.allclose(plan.evaluate(theta), uncached.evaluate(theta), rtol=0, atol=1e-14)
+  assert (plan.tau_cache.hits, plan.tau_cache.misses) == (4, 4)
+  # a step in b only evaluates the two lines of that component again
+  theta[0] *= 1.01
+  assert np.allclose(plan.evaluate(theta), uncached.evaluate(theta), rtol=0, atol=1e-14)
+  assert (plan.tau_cache.hits, plan.tau_cache.misses) == (6, 6)
+
+
+def test_wrapper_parameter_order():
+  from astrovoigtfit import Voigt_fit_wrapper, _free_parameter_map, _species_parameters
+  from model import ModelPlan
+  wavegrid = np.linspace(4231.5, 4233.5, 800)
+  ch = {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8]}
+  species = {0: dict(ch, b=[2.0, 1.5], N=[1e12, 2e12], v_rad=[-5.0, 6.0]),
+             1: {'lambda': [4232.548, 4232.1], 'f': [0.003, 0.002], 'gamma': [1e8, 1e8],
+                 'b': [2.5, 1.0], 'N': [3e12, 4e12], 'v_rad': [-5.0, 6.0]},
+             2: dict(ch, b=[3.0], N=[5e11], v_rad=[-5.0])}
+  params = _species_parameters(species, 3.0, 25)
+  plan = ModelPlan(wavegrid, species, v_resolution=3.0)
+
+  # move the tied velocities and give every component its own b and N
+  params['master_v_rad_0_neg5p0'].value = -4.0
+  params['master_v_rad_1_6p0'].value = 7.5
+  components = [(0, 0), (0, 1), (1, 0), (1, 1), (2, 0)]
+  for k, (s, i) in enumerate(components):
+    params[f'b_{s}_{i}'].value = 1.0 + 0.3 * k
+    params[f'N_{s}_{i}'].value = 1e12 * (k + 1)
+  theta = np.array([1.0 + 0.3 * k for k in range(5)] + [1e12 * (k + 1) for k in range(5)]
+                   + [-4.0, 7.5, -4.0, 7.5, -4.0])
+  assert plan.components == components
+
+  values = params.valuesdict()
+  model = Voigt_fit_wrapper(wavegrid=wavegrid, plan=plan, **values)
+  assert np.array_equal(model, plan.evaluate(theta))
+  # the path without a plan (master_function) reads the same parameters by name
+  assert np.abs(Voigt_fit_wrapper(wavegrid=wavegrid, **values) - model).max() < 1e-4
+
+  var_names, dtheta = _free_parameter_map(params, plan)
+  assert np.array_equal(dtheta @ [values[name] for name in var_names], theta)
+
+
+def test_astro_voigt_sample():
+  from model import master_function
+  from astrovoigtfit import astro_voigt_sample
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[0.0])
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.2], 'N': [8e12], 'v_rad': [0.5]}}
+  result = astro_voigt_sample(wavegrid, ydata, species, v_resolution=3.0, std_dev=0.002,
+                              n_walkers=8, n_steps=40, seed=0)
+  assert result.chain.shape == (40, 8, 3) and len(result.flatchain) == 20 * 8
+  assert abs(result.params['N_0_0'].value / 1e13 - 1) < 0.01
+
+
+def test_astro_voigt_fit_joint():
+  from model import master_function
+  from astrovoigtfit import astro_voigt_fit_joint
+  rng = np.random.default_rng(0)
+  exposures = []
+  for n_pixels, v_resolution, offset in ((400, 3.0, 0.0), (300, 4.0, 1.5)):
+    wavegrid = np.linspace(4231.5, 4233.5, n_pixels)
+    ydata = master_function(wavegrid, v_resolution=v_resolution, lambda_1st=[4232.288], f_1st=[0.00545],
+                            gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[offset])
+    exposures.append((wavegrid, ydata + rng.normal(0, 0.002, n_pixels), 0.002, v_resolution))
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.5], 'N': [5e12], 'v_rad': [1.0]}}
+  result = astro_voigt_fit_joint(exposures, species, velocity_offsets=True, jacobian='analytic')
+  assert [fit.shape for fit in result.exposure_fits] == [(400,), (300,)]
+  assert abs(result.params['N_0_0'].value / 1e13 - 1) < 0.02
+  assert abs(result.params['v_offset_1'].value - 1.5) < 0.1
+
+
+def test_continuum_variable_projection():
+  from numpy.polynomial.chebyshev import Chebyshev
+  from model import master_function
+  from astrovoigtfit import astro_voigt_fit
+  wavegrid = np.linspace(4230.5, 4234.0, 700)
+  absorption = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                               gamma_1st=[1e8], b_1st=[2.0], N_1st=[3e13], v_rad_1st=[0.0])
+  continuum = Chebyshev([1000, 40, -25, 8], domain=(wavegrid.min(), wavegrid.max()))(wavegrid)
+  flux = absorption * continuum + np.random.default_rng(0).normal(0, 2.0, wavegrid.size)
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.5], 'N': [1e13], 'v_rad': [1.0]}}
+  result = astro_voigt_fit(wavegrid, flux, species, v_resolution=3.0, std_dev=2.0, continuum_degree=3,
+                           jacobian='analytic')
+  # only b, N and v_rad are free: the continuum coefficients are solved for
+  assert len(result.var_names) == 3
+  assert abs(result.params['N_0_0'].value / 3e13 - 1) < 0.02
+  assert np.allclose(result.continuum, continuum, rtol=1e-3)
+  assert np.allclose(result.continuum_poly(wavegrid), result.continuum)
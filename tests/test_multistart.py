@@ -0,0 +1,52 @@
+import time
+import numpy as np
+import multistart
+from model import master_function
+from multistart import astro_voigt_multistart, starting_points
+
+
+def _slow_fit_start(args):
+  # stand-in for multistart._fit_start: the first three starts agree at once, the others take long
+  index, wavegrid, ydata, species_params, fit_kwargs = args
+  if index >= 3:
+    time.sleep(2)
+  values = {f'{key}_0_0': species_params[0][key][0] for key in ('b', 'N', 'v_rad')}
+  return {'start': index, 'chisqr': 1.0, 'success': True, 'nfev': 1, 'values': values}
+
+
+def test_starting_points():
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2, 2], 'N': [1e11, 1e11], 'v_rad': [-11, 4]},
+             1: {'lambda': [4232.548], 'f': [0.00545], 'gamma': [1e8], 'b': [2, 2], 'N': [1e13, 1e13], 'v_rad': [-11, 4]}}
+  starts = starting_points(species, 9, seed=0)
+  assert len(starts) == 9 and starts[0] == species
+  b = np.array([start[0]['b'][0] for start in starts[1:]])
+  # one start in every eighth of the b range
+  assert sorted(((b - 0.5) / 5 * 8).astype(int)) == list(range(8))
+  # the tied v_rad guesses stay tied
+  assert all(np.array_equal(start[0]['v_rad'], start[1]['v_rad']) for start in starts)
+
+
+def test_multistart():
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[0.0])
+  ydata = ydata + np.random.default_rng(0).normal(0, 0.002, wavegrid.size)
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [5.0], 'N': [1e11], 'v_rad': [6.0]}}
+  result = astro_voigt_multistart(wavegrid, ydata, species, n_starts=8, n_workers=1, seed=0,
+                                  v_resolution=3.0, std_dev=0.002)
+  assert 3 <= len(result.starts) <= 8
+  assert result.chisqr <= min(start['chisqr'] for start in result.starts) * 1.001
+  assert abs(result.params['N_0_0'].value / 1e13 - 1) < 0.05
+
+
+def test_multistart_early_stop(monkeypatch):
+  monkeypatch.setattr(multistart, '_fit_start', _slow_fit_start)
+  wavegrid = np.linspace(4231.5, 4233.5, 400)
+  ydata = master_function(wavegrid, v_resolution=3.0, lambda_1st=[4232.288], f_1st=[0.00545],
+                          gamma_1st=[1e8], b_1st=[2.0], N_1st=[1e13], v_rad_1st=[0.0])
+  species = {0: {'lambda': [4232.288], 'f': [0.00545], 'gamma': [1e8], 'b': [2.0], 'N': [1e13], 'v_rad': [0.0]}}
+  start = time.perf_counter()
+  result = astro_voigt_multistart(wavegrid, ydata, species, n_starts=8, n_workers=2, seed=0, v_resolution=3.0)
+  # returns without waiting for the slow starts still running
+  assert time.perf_counter() - start < 1.5
+  assert sorted(summary['start'] for summary in result.starts) == [0, 1, 2]
@@ -0,0 +1,33 @@
+import json
+import os
+import numpy as np
+import observation_cache
+
+
+def test_cached_observations(tmp_path, monkeypatch):
+  monkeypatch.setattr(observation_cache, 'CACHE_DIR', str(tmp_path))
+  monkeypatch.setattr(observation_cache, '_obs_lists', None)
+  wave = np.linspace(4231.5, 4233.5, 100)
+  flux = 1.0 - 0.1 * np.exp(-0.5 * ((wave - 4232.5) / 0.05) ** 2)
+
+  # cached entries are served without the EDIBLES Oracle or FITS files
+  assert observation_cache.load_window('HD183143/RED_346/file.fits', (4231.5, 4233.5)) is None
+  observation_cache.save_window('HD183143/RED_346/file.fits', (4231.5, 4233.5), wave, flux)
+  (tmp_path / 'obs_lists.json').write_text(json.dumps({'HD 183143|4232.0': ['HD183143/RED_346/file.fits']}))
+
+  filename = observation_cache.observation_list('HD 183143', 4232)[0]
+  cached_wave, cached_flux = observation_cache.observation_window(filename, [4231.5, 4233.5])
+  assert np.array_equal(cached_wave, wave) and np.array_equal(cached_flux, flux)
+
+
+def test_concurrent_save_window(tmp_path, monkeypatch):
+  from concurrent.futures import ThreadPoolExecutor
+  monkeypatch.setattr(observation_cache, 'CACHE_DIR', str(tmp_path))
+  wave = np.linspace(4231.5, 4233.5, 100000)
+  flux = np.ones(wave.size)
+  # threads of one process (as in fit_server) writing the same window
+  with ThreadPoolExecutor(8) as pool:
+    list(pool.map(lambda _: observation_cache.save_window('file.fits', (4231.5, 4233.5), wave, flux), range(32)))
+  assert np.array_equal(observation_cache.load_window('file.fits', (4231.5, 4233.5))[0], wave)
+  # no temporary files left behind
+  assert [path.name for path in tmp_path.iterdir()] == [os.path.basename(observation_cache._window_path('file.fits', (4231.5, 4233.5)))]
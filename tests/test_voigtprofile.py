@@ -2,3 +2,13 @@ from functions.voigtprofile import voigt_profile
 
 def test_voigt():
   assert voigt_profile(2.5,3,9) == 0.030695779845761356
+
+
+def test_voigt_backends():
+  import numpy as np
+  from functions.faddeeva import BACKEND_MAX_REL_ERROR
+  x = np.linspace(-30, 30, 601)
+  exact = voigt_profile(x, 3, 0.01)
+  for backend in ("humlicek", "weideman"):
+    approx = voigt_profile(x, 3, 0.01, backend=backend)
+    assert np.max(np.abs(approx / exact - 1)) < BACKEND_MAX_REL_ERROR[backend]